@@ -5,19 +5,32 @@
     :copyright: © 2018 Grey Li
     :license: MIT, see LICENSE for more details.
 """
+import os
+import threading
 import time
 
-from flask import Flask, url_for, redirect, request, flash, render_template
-from flask_caching import Cache
+import click
+from flask import Flask, url_for, redirect, request, flash, render_template, jsonify
 from flask_debugtoolbar import DebugToolbarExtension
 
+from caching import Cache, KeyBuilder
+
 app = Flask(__name__)
 app.jinja_env.trim_blocks = True
 app.jinja_env.lstrip_blocks = True
 
 app.config['SECRET_KEY'] = 'dev key'
 
-app.config['CACHE_TYPE'] = 'simple'
+# set CACHE_TYPE=backends.two_tier to share the cache between workers
+# through Redis, with a small per-worker cache in front of it
+app.config['CACHE_TYPE'] = os.getenv('CACHE_TYPE', 'backends.lru')
+app.config['CACHE_MAX_BYTES'] = 64 * 1024 * 1024
+app.config['CACHE_REDIS_URL'] = os.getenv('CACHE_REDIS_URL', 'redis://localhost:6379/0')
+app.config['CACHE_L1_TIMEOUT'] = 5
+app.config['CACHE_REFRESH_WORKERS'] = 4
+app.config['CACHE_COMPRESS_MIN_SIZE'] = 500
+# the debug toolbar can't insert itself into compressed pages
+app.config['CACHE_COMPRESS_LEVELS'] = {} if app.debug else {'br': 4, 'gzip': 6}
 app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
 
 cache = Cache(app)
@@ -35,46 +48,91 @@ def foo():
     return render_template('foo.html')
 
 
+# stale after the soft timeout, re-rendered in the background while the old
+# page is still served; browsers revalidating it get a 304, the gzip and
+# brotli versions are cached with the page
 @app.route('/bar')
-@cache.cached(timeout=10 * 60)
+@cache.cached(timeout=10 * 60, soft_timeout=60, tags=['view', 'view:bar'], compress=True)
 def bar():
     time.sleep(1)
     return render_template('bar.html')
 
 
 @app.route('/baz')
-@cache.cached(timeout=60 * 60)
+@cache.cached(timeout=60 * 60, soft_timeout=5 * 60, tags=['view', 'view:baz'], compress=True)
 def baz():
     time.sleep(1)
     return render_template('baz.html')
 
 
+# one entry per query string, the tag lets them go away together
 @app.route('/qux')
-@cache.cached(query_string=True)
+@cache.cached(query_string=True, tags=['view', 'view:qux'], compress=True)
 def qux():
     time.sleep(1)
     page = request.args.get('page', 1)
     return render_template('qux.html', page=page)
 
 
+movies = [
+    {'name': 'My Neighbor Totoro', 'year': '1988'},
+    {'name': 'Three Colours trilogy', 'year': '1993'},
+    {'name': 'Forrest Gump', 'year': '1994'},
+    {'name': 'Perfect Blue', 'year': '1997'},
+    {'name': 'The Matrix', 'year': '1999'},
+    {'name': 'Memento', 'year': '2000'},
+    {'name': 'The Bucket list', 'year': '2007'},
+    {'name': 'Black Swan', 'year': '2010'},
+    {'name': 'Gone Girl', 'year': '2014'},
+    {'name': 'CoCo', 'year': '2017'},
+]
+
+
+# a slow filter, only the fragment using it is cached
+@app.template_filter()
+def review(movie):
+    time.sleep(0.1)
+    return '%s (%s)' % (movie['name'], movie['year'])
+
+
+# the page is rendered for every user, the movie list only once
+@app.route('/watchlist')
+def watchlist():
+    username = request.args.get('username', 'Grey Li')
+    return render_template('watchlist.html', username=username, movies=movies)
+
+
+@app.route('/stats')
+def stats():
+    return jsonify(cache.cache.stats())
+
+
 @app.route('/update/bar')
 def update_bar():
-    cache.delete('view/%s' % url_for('bar'))
-    flash('Cached data for bar have been deleted.')
+    cache.mark_stale('view/%s' % url_for('bar'))
+    flash('Cached data for bar will be refreshed on the next visit.')
     return redirect(url_for('index'))
 
 
 @app.route('/update/baz')
 def update_baz():
-    cache.delete('view/%s' % url_for('baz'))
-    flash('Cached data for baz have been deleted.')
+    cache.mark_stale('view/%s' % url_for('baz'))
+    flash('Cached data for baz will be refreshed on the next visit.')
+    return redirect(url_for('index'))
+
+
+@app.route('/update/qux')
+def update_qux():
+    cache.invalidate_tag('view:qux')
+    flash('Cached data for every qux page have been deleted.')
     return redirect(url_for('index'))
 
 
 @app.route('/update/all')
 def update_all():
-    cache.clear()
-    flash('All cached data deleted.')
+    # only the pages, memoized functions stay warm
+    cache.invalidate_tag('view')
+    flash('Cached data for all pages deleted.')
     return redirect(url_for('index'))
 
 
@@ -86,7 +144,7 @@ def add(a, b):
 
 
 # cache memorize (with argument)
-@cache.memoize()
+@cache.memoize(key_builder=KeyBuilder())
 def add_pro(a, b):
     time.sleep(2)
     return a + b
@@ -99,3 +157,87 @@ def del_add_cache():
 # delete memorized cache
 def del_pro_cache():
     cache.delete_memoized(add_pro)
+
+
+# stampede load test
+@app.cli.command('bench-stampede')
+@click.option('--clients', default=200, help='Concurrent requests per expiry.')
+@click.option('--rounds', default=3, help='How many times the key expires.')
+def bench_stampede(clients, rounds):
+    """Hit /bar with many concurrent clients right after its cache entry
+    expires, and count how often it gets rendered."""
+    app.config['DEBUG_TB_ENABLED'] = False
+    with app.test_request_context():
+        key = 'view/%s' % url_for('bar')
+    for n in range(rounds):
+        cache.delete(key)  # expire it
+        before = cache.computations[key]
+        barrier = threading.Barrier(clients)
+        statuses = []
+
+        def client():
+            with app.test_client() as c:
+                barrier.wait()
+                statuses.append(c.get('/bar').status_code)
+
+        started = time.time()
+        threads = [threading.Thread(target=client) for _ in range(clients)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        click.echo('expiry %d: %d requests (%d OK) in %.2fs, %d recomputation(s)' % (
+            n + 1, clients, statuses.count(200), time.time() - started, cache.computations[key] - before))
+
+
+# memoize key benchmark
+@app.cli.command('bench-memoize')
+@click.option('--calls', default=2000, help='Cached calls per case.')
+def bench_memoize(calls):
+    """Measure the per-call overhead of cached add_pro() calls with
+    Flask-Caching's key derivation and with KeyBuilder."""
+
+    @cache.memoize()
+    def add_pro_md5(a, b):
+        return a + b
+
+    cases = [
+        ('small', (1, 2)),
+        ('list 10k', (list(range(10000)), list(range(10000)))),
+        ('nested 1k', ([{'id': i, 'tags': ['a', 'b']} for i in range(1000)], [])),
+    ]
+    with app.test_request_context():
+        for name, args in cases:
+            for label, func in (('md5+str', add_pro_md5), ('KeyBuilder', add_pro)):
+                func(*args)  # warm up, pays the sleep
+                started = time.time()
+                for _ in range(calls):
+                    func(*args)
+                click.echo('%-10s %-10s %8.1f us/call' % (name, label, (time.time() - started) / calls * 1e6))
+
+
+# conditional GET benchmark
+@app.cli.command('bench-conditional')
+@click.option('--requests', 'count', default=1000, help='Requests per case.')
+def bench_conditional(count):
+    """Compare full and compressed responses of the cached /bar and /baz
+    pages with revalidations answered by a 304."""
+    app.config['DEBUG_TB_ENABLED'] = False
+    client = app.test_client(use_cookies=False)
+    for path in ('/bar', '/baz'):
+        response = client.get(path)  # warm up, pays the sleep
+        cases = [
+            ('full', {}),
+            ('gzip', {'Accept-Encoding': 'gzip'}),
+            ('br', {'Accept-Encoding': 'br'}),
+            ('If-None-Match', {'If-None-Match': response.headers['ETag']}),
+            ('If-Modified-Since', {'If-Modified-Since': response.headers['Last-Modified']}),
+        ]
+        for label, headers in cases:
+            sent = 0
+            started = time.time()
+            for _ in range(count):
+                response = client.get(path, headers=headers)
+                sent += len(response.get_data())
+            click.echo('%-5s %-18s %d %8.1f us/request %8d body bytes' % (
+                path, label, response.status_code, (time.time() - started) / count * 1e6, sent))
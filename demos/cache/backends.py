@@ -0,0 +1,305 @@
+# -*- coding: utf-8 -*-
+"""
+    :author: Grey Li (李辉)
+    :url: http://greyli.com
+    :copyright: © 2018 Grey Li
+    :license: MIT, see LICENSE for more details.
+"""
+import logging
+import os
+import pickle
+import threading
+import uuid
+from collections import OrderedDict
+from time import sleep, time
+
+from flask_caching.backends.base import BaseCache
+from flask_caching.backends.rediscache import RedisCache
+
+logger = logging.getLogger(__name__)
+
+
+class LRUCache(BaseCache):
+    """In-process cache with least-recently-used eviction, a per-key timeout
+    and a memory budget counted in bytes of pickled values.
+
+    Unlike the ``simple`` backend, which throws away every third entry once
+    it has too many, a full cache evicts exactly the entries that were used
+    least recently, and every operation is O(1).  All operations hold a lock,
+    so it is safe under threaded workers.
+
+    :param max_bytes: evict entries once the stored values exceed this size.
+    :param max_entries: optional limit on the number of entries as well.
+    :param default_timeout: timeout used when :meth:`set` gets none,
+                            0 means never expire.
+    """
+
+    def __init__(self, max_bytes=64 * 1024 * 1024, max_entries=None, default_timeout=300):
+        super(LRUCache, self).__init__(default_timeout)
+        self._cache = OrderedDict()  # key -> (expires, pickled value), oldest first
+        self._lock = threading.RLock()
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.hits = self.misses = self.evictions = self.bytes = 0
+
+    def _normalize_timeout(self, timeout):
+        timeout = BaseCache._normalize_timeout(self, timeout)
+        if timeout > 0:
+            timeout = time() + timeout
+        return timeout
+
+    def _pop(self, key):
+        expires, value = self._cache.pop(key)
+        self.bytes -= len(value)
+
+    def _lookup(self, key):
+        """Return the pickled value of a live entry and mark it as recently
+        used, or None.  Must be called with the lock held."""
+        try:
+            expires, value = self._cache[key]
+        except KeyError:
+            return None
+        if expires != 0 and expires <= time():
+            self._pop(key)
+            return None
+        self._cache.move_to_end(key)
+        return value
+
+    def _store(self, key, value, expires):
+        value = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        with self._lock:
+            if key in self._cache:
+                self._pop(key)
+            if len(value) > self.max_bytes:
+                # too large to keep, but the old value is stale all the same
+                return False
+            self._cache[key] = (expires, value)
+            self.bytes += len(value)
+            while self.bytes > self.max_bytes or (self.max_entries and len(self._cache) > self.max_entries):
+                self._pop(next(iter(self._cache)))
+                self.evictions += 1
+        return True
+
+    def get(self, key):
+        with self._lock:
+            value = self._lookup(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return pickle.loads(value)
+
+    def set(self, key, value, timeout=None):
+        return self._store(key, value, self._normalize_timeout(timeout))
+
+    def add(self, key, value, timeout=None):
+        with self._lock:
+            if self._lookup(key) is not None:
+                return False
+            return self._store(key, value, self._normalize_timeout(timeout))
+
+    def delete(self, key):
+        with self._lock:
+            if key not in self._cache:
+                return False
+            self._pop(key)
+        return True
+
+    def has(self, key):
+        with self._lock:
+            return self._lookup(key) is not None
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+            self.bytes = 0
+        return True
+
+    def inc(self, key, delta=1):
+        with self._lock:
+            value = self._lookup(key)
+            if value is None:
+                value, expires = delta, self._normalize_timeout(None)
+            else:
+                # keep the entry's original expiry
+                value, expires = pickle.loads(value) + delta, self._cache[key][0]
+            self._store(key, value, expires)
+        return value
+
+    def dec(self, key, delta=1):
+        return self.inc(key, -delta)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': float(self.hits) / lookups if lookups else 0.0,
+                'evictions': self.evictions,
+                'entries': len(self._cache),
+                'bytes': self.bytes,
+                'max_bytes': self.max_bytes,
+            }
+
+
+def lru(app, config, args, kwargs):
+    """Flask-Caching factory for :class:`LRUCache`, use it with
+    ``CACHE_TYPE = 'backends.lru'``."""
+    kwargs.update(dict(
+        max_bytes=config.get('CACHE_MAX_BYTES', 64 * 1024 * 1024),
+        max_entries=config.get('CACHE_MAX_ENTRIES'),
+    ))
+    return LRUCache(*args, **kwargs)
+
+
+class _RedisCache(RedisCache):
+    """Flask-Caching's Redis cache with an atomic :meth:`add`.  The stock one
+    runs ``SETNX`` then ``EXPIRE``, two steps, and with a timeout of 0
+    expires the key right away instead of never."""
+
+    def add(self, key, value, timeout=None):
+        timeout = BaseCache._normalize_timeout(self, timeout)
+        return bool(self._write_client.set(name=self._get_prefix() + key, value=self.dump_object(value),
+                                           nx=True, ex=timeout or None))
+
+
+class TwoTierCache(BaseCache):
+    """A small, short-lived :class:`LRUCache` (L1) in every worker in front
+    of a Redis cache (L2) shared by all of them.
+
+    Reads try L1 first and fill it from L2 on a miss.  Writes and deletes go
+    to both tiers and are published on a Redis pub/sub channel; every other
+    worker listens on it and drops the key from its own L1, so a
+    ``cache.delete`` in one worker is seen by all of them.  The short L1
+    timeout bounds staleness should a message get lost.
+
+    :param client: a Redis client, anything with the redis-py API works
+                   (e.g. ``fakeredis.FakeStrictRedis`` in tests).
+    :param l1_timeout: how long a value may live in L1.
+    :param l1_max_bytes: memory budget of L1.
+    :param channel: pub/sub channel for invalidations.
+    :param key_prefix: prefix for the L2 keys.
+    """
+
+    def __init__(self, client, default_timeout=300, l1_timeout=5, l1_max_bytes=16 * 1024 * 1024,
+                 channel='cache-invalidations', key_prefix=None):
+        super(TwoTierCache, self).__init__(default_timeout)
+        self.client = client
+        self.l1 = LRUCache(max_bytes=l1_max_bytes, default_timeout=l1_timeout)
+        self.l1_timeout = l1_timeout
+        self.l2 = _RedisCache(host=client, default_timeout=default_timeout, key_prefix=key_prefix)
+        self.channel = channel
+        self.node_id = uuid.uuid4().hex
+        self._listener_pid = None
+        self._listener_lock = threading.Lock()
+        self.l2_hits = self.l2_misses = 0
+
+    def _l1_timeout(self, timeout):
+        timeout = self._normalize_timeout(timeout)
+        return min(timeout, self.l1_timeout) if timeout else self.l1_timeout
+
+    def _ensure_listener(self):
+        # one listener per process, forked workers start their own
+        if self._listener_pid == os.getpid():
+            return
+        with self._listener_lock:
+            if self._listener_pid != os.getpid():
+                self.node_id = uuid.uuid4().hex
+                listener = threading.Thread(target=self._listen)
+                listener.daemon = True
+                listener.start()
+                self._listener_pid = os.getpid()
+
+    def _listen(self):
+        while True:
+            try:
+                pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(self.channel)
+                # anything cached while we were not listening may be stale
+                self.l1.clear()
+                for message in pubsub.listen():
+                    if message['type'] != 'message':
+                        continue
+                    node_id, key = message['data'].decode('utf-8').split(' ', 1)
+                    if node_id == self.node_id:
+                        continue
+                    if key == '*':
+                        self.l1.clear()
+                    else:
+                        self.l1.delete(key)
+            except Exception:
+                logger.exception('Cache invalidation listener failed, reconnecting.')
+                sleep(1)
+
+    def _publish(self, key):
+        self.client.publish(self.channel, '%s %s' % (self.node_id, key))
+
+    def get(self, key):
+        self._ensure_listener()
+        value = self.l1.get(key)
+        if value is None:
+            value = self.l2.get(key)
+            if value is None:
+                self.l2_misses += 1
+            else:
+                self.l2_hits += 1
+                self.l1.set(key, value, timeout=self.l1_timeout)
+        return value
+
+    def has(self, key):
+        return self.l1.has(key) or self.l2.has(key)
+
+    def set(self, key, value, timeout=None):
+        self._ensure_listener()
+        rv = self.l2.set(key, value, timeout=timeout)
+        self.l1.set(key, value, timeout=self._l1_timeout(timeout))
+        self._publish(key)
+        return rv
+
+    def add(self, key, value, timeout=None):
+        # only L2 can tell whether the key exists anywhere
+        if not self.l2.add(key, value, timeout=timeout):
+            return False
+        self.l1.set(key, value, timeout=self._l1_timeout(timeout))
+        return True
+
+    def delete(self, key):
+        self.l1.delete(key)
+        rv = self.l2.delete(key)
+        self._publish(key)
+        return rv
+
+    def clear(self):
+        self.l1.clear()
+        rv = self.l2.clear()
+        self._publish('*')
+        return rv
+
+    def inc(self, key, delta=1):
+        self.l1.delete(key)
+        rv = self.l2.inc(key, delta)
+        self._publish(key)
+        return rv
+
+    def dec(self, key, delta=1):
+        return self.inc(key, -delta)
+
+    def stats(self):
+        return dict(self.l1.stats(), l2_hits=self.l2_hits, l2_misses=self.l2_misses)
+
+
+def two_tier(app, config, args, kwargs):
+    """Flask-Caching factory for :class:`TwoTierCache`, use it with
+    ``CACHE_TYPE = 'backends.two_tier'`` and ``CACHE_REDIS_URL``."""
+    try:
+        import redis
+    except ImportError:
+        raise RuntimeError('no redis module found')
+    kwargs.update(dict(
+        client=redis.from_url(config.get('CACHE_REDIS_URL', 'redis://localhost:6379/0')),
+        l1_timeout=config.get('CACHE_L1_TIMEOUT', 5),
+        l1_max_bytes=config.get('CACHE_MAX_BYTES', 16 * 1024 * 1024),
+        key_prefix=config.get('CACHE_KEY_PREFIX'),
+    ))
+    return TwoTierCache(*args, **kwargs)
@@ -0,0 +1,471 @@
+# -*- coding: utf-8 -*-
+"""
+    :author: Grey Li (李辉)
+    :url: http://greyli.com
+    :copyright: © 2018 Grey Li
+    :license: MIT, see LICENSE for more details.
+"""
+import functools
+import gzip
+import hashlib
+import inspect
+import io
+import pickle
+import time
+import uuid
+from collections import Counter, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import current_app, has_request_context, make_response, request
+from flask_caching import Cache as _Cache
+from jinja2 import nodes
+from jinja2.environment import TemplateModule
+from jinja2.ext import Extension
+from jinja2.runtime import Undefined
+
+try:
+    import brotli
+except ImportError:  # gzip only
+    brotli = None
+
+try:
+    import xxhash
+
+    def fast_hash(data):
+        return xxhash.xxh3_128_hexdigest(data)
+except ImportError:
+    def fast_hash(data):
+        return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+#: what decorators with a ``soft_timeout`` or ``tags`` store: the value, when
+#: it turns stale (None for never), when the backend drops it (0 for never)
+#: and the version of each tag when it was computed
+CacheEntry = namedtuple('CacheEntry', ['value', 'fresh_until', 'expires', 'tags'])
+
+#: what ``cached(conditional=True)`` views store: the body, its ETag, when it
+#: was rendered and, with ``compress=True``, its compressed variants as
+#: ``{encoding: (data, etag)}``, so a hit never re-hashes nor recompresses
+Validated = namedtuple('Validated', ['body', 'etag', 'last_modified', 'variants'])
+
+
+def _sorted(items, key=None):
+    try:
+        return sorted(items, key=key)
+    except TypeError:  # mixed types
+        return sorted(items, key=lambda item: repr(key(item) if key else item))
+
+
+def _identity(*args):
+    """Stands in for model instances in pickled keys, never called."""
+
+
+class _KeyPickler(pickle.Pickler):
+    def __init__(self, file, identity):
+        pickle.Pickler.__init__(self, file, pickle.HIGHEST_PROTOCOL)
+        self.identity = identity
+
+    def reducer_override(self, obj):
+        # only called for non-builtin types, the rest stays on the C fast path
+        if self.identity:
+            cls = type(obj)
+            if hasattr(obj, '__cache_key__'):
+                return _identity, (cls.__module__, cls.__qualname__, obj.__cache_key__())
+            mapper = getattr(cls, '__mapper__', None)
+            if mapper is not None:
+                return _identity, (cls.__module__, cls.__qualname__, tuple(mapper.primary_key_from_instance(obj)))
+        return NotImplemented
+
+
+class KeyBuilder(object):
+    """Cache key builder for :meth:`Cache.memoize`.
+
+    Flask-Caching formats every argument with ``str()`` and hashes the text
+    with md5 on each call, which gets slow for big arguments and isn't stable
+    across processes (``str()`` of a set depends on hash randomization, plain
+    objects show their ``id()``).  This builder binds the arguments to
+    parameter names, pickles them and hashes the bytes with xxhash when it is
+    installed, BLAKE2b otherwise.  Set and dict arguments are sorted first;
+    sets nested deeper are pickled as they are, which at worst costs a cache
+    miss in another process, never a wrong hit.
+
+    :param identity: key SQLAlchemy model instances (and anything with a
+                     ``__cache_key__()`` method) by class and primary key
+                     instead of by their whole state.
+    """
+
+    def __init__(self, identity=False):
+        self.identity = identity
+        self._signatures = {}
+
+    def _signature(self, f):
+        """Return f's signature and its number of plain positional
+        parameters, calls passing exactly those need no binding."""
+        try:
+            return self._signatures[f]
+        except KeyError:
+            signature = inspect.signature(f)
+            kinds = [parameter.kind for parameter in signature.parameters.values()]
+            simple = all(kind == inspect.Parameter.POSITIONAL_OR_KEYWORD for kind in kinds)
+            rv = self._signatures[f] = (signature, len(kinds) if simple else -1)
+            return rv
+
+    @staticmethod
+    def canonical(arg):
+        cls = type(arg)
+        if cls is set or cls is frozenset:
+            return 'set', tuple(_sorted(arg))
+        if cls is dict:
+            return 'dict', tuple(_sorted(arg.items(), key=lambda item: item[0]))
+        return arg
+
+    def __call__(self, f, args, kwargs):
+        signature, positional = self._signature(f)
+        if kwargs or len(args) != positional:
+            # f(1), f(1, b=2) and f(a=1, b=2) are the same call
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            args = bound.args + tuple(sorted(bound.kwargs.items()))
+        return self.hash((f.__module__, f.__qualname__, tuple(self.canonical(arg) for arg in args)))
+
+    def hash(self, data, strict=False):
+        """Pickle ``data`` and return a hex digest of it.  What can't be
+        pickled is hashed by its ``repr()``, or raises with ``strict``."""
+        buffer = io.BytesIO()
+        try:
+            _KeyPickler(buffer, self.identity).dump(data)
+            data = buffer.getvalue()
+        except (pickle.PicklingError, TypeError, AttributeError):
+            if strict:
+                raise
+            data = repr(data).encode('utf-8')
+        return fast_hash(data)
+
+
+class FragmentCacheExtension(Extension):
+    """Caches the output of a template fragment::
+
+        {% cache 'watchlist', 300 %}
+            {% for movie in movies %}...{% endfor %}
+        {% endcache %}
+
+    The key is the fragment name plus a hash of the variables the fragment
+    reads, found when the template is compiled: here ``movies``, so another
+    list renders into another entry and a user name shown around the
+    fragment doesn't split it.  Template globals (``request``, ``url_for``,
+    ...) and macros are left out; anything else the output depends on can
+    be listed after the timeout, e.g. ``{% cache 'notes', 60, request.args.page %}``.
+
+    Fragments reading something that can't be pickled, like a form, are
+    never cached.  Entries are stored through
+    :meth:`Cache._get_or_compute`, so a missing fragment is rendered once
+    however many requests want it.
+    """
+
+    tags = {'cache'}
+
+    def __init__(self, environment):
+        super(FragmentCacheExtension, self).__init__(environment)
+        environment.extend(fragment_cache=None, fragment_key_builder=KeyBuilder())
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        name = parser.parse_expression()
+        parser.stream.expect('comma')
+        timeout = parser.parse_expression()
+        dependencies = []
+        while parser.stream.skip_if('comma'):
+            dependencies.append(parser.parse_expression())
+        body = parser.parse_statements(['name:endcache'], drop_needle=True)
+        dependencies.extend(nodes.Name(name, 'load') for name in self._free_names(body))
+        call = self.call_method('_render', [name, timeout, nodes.List(dependencies)])
+        return nodes.CallBlock(call, [], [], body).set_lineno(lineno)
+
+    def _free_names(self, body):
+        """Names the fragment reads but doesn't set itself."""
+        loaded, stored = set(), set()
+        for node in body:
+            for name in node.find_all(nodes.Name):
+                (loaded if name.ctx == 'load' else stored).add(name.name)
+        return sorted(loaded - stored - set(self.environment.globals))
+
+    def _render(self, name, timeout, dependencies, caller):
+        cache = self.environment.fragment_cache
+        builder = self.environment.fragment_key_builder
+        dependencies = [builder.canonical(value) for value in dependencies
+                        if not (callable(value) or isinstance(value, (TemplateModule, Undefined)))]
+        try:
+            key = 'fragment/%s/%s' % (name, builder.hash(dependencies, strict=True))
+        except (pickle.PicklingError, TypeError, AttributeError):
+            # a repr() with an id() in it could match another request's
+            # objects, render it every time instead
+            return caller()
+        return cache._get_or_compute(key, caller, dict(
+            timeout=timeout, lock_timeout=10, soft_timeout=None, response_filter=None, tags=None))
+
+
+class Cache(_Cache):
+    """Flask-Caching's :class:`~flask_caching.Cache` whose ``cached`` and
+    ``memoize`` decorators are single-flight: when a key is missing, only the
+    caller that takes the key's lock recomputes it, everybody else waits for
+    the value to show up instead of recomputing it at the same time.
+
+    The lock is a ``lock/<key>`` entry created with the backend's atomic
+    ``add``, so it works across threads and, with a shared backend, across
+    worker processes.  It expires after ``lock_timeout`` seconds so a crashed
+    worker can't block a key forever; waiters that time out compute the value
+    themselves.
+
+    Both decorators also take a ``soft_timeout``, shorter than ``timeout``.
+    Past the soft timeout the entry is stale: it is still served right away,
+    and one background worker regenerates it, so no visitor waits for a
+    render once the key is warm.  :meth:`mark_stale` turns an entry stale
+    on purpose, which is how to "refresh" a page rather than delete it.
+
+    Entries can carry ``tags``, e.g. ``view:qux`` or ``model:note:42``.  Each
+    tag has a version stored under ``tag/<name>``, and an entry is only valid
+    while the versions it was computed with are current, so
+    :meth:`invalidate_tag` drops every entry with a tag by bumping one
+    version, whatever their keys are; the dead entries just age out.
+
+    Templates get a ``{% cache %}`` tag for fragments, see
+    :class:`FragmentCacheExtension`; it replaces Flask-Caching's own tag.
+    """
+
+    #: seconds between two looks at the cache while waiting for a value
+    poll_interval = 0.05
+
+    def __init__(self, app=None, with_jinja2_ext=True, config=None):
+        #: how many times each key was actually computed
+        self.computations = Counter()
+        self._executor = None
+        self.with_fragment_cache = with_jinja2_ext
+        super(Cache, self).__init__(app, with_jinja2_ext=False, config=config)
+
+    def init_app(self, app, config=None):
+        super(Cache, self).init_app(app, config)
+        if self.with_fragment_cache:
+            app.jinja_env.add_extension(FragmentCacheExtension)
+            app.jinja_env.fragment_cache = self
+
+    @property
+    def executor(self):
+        """Thread pool running background refreshes, sized by
+        ``CACHE_REFRESH_WORKERS``."""
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=current_app.config.get('CACHE_REFRESH_WORKERS', 4))
+        return self._executor
+
+    def mark_stale(self, key):
+        """Make a soft-timeout entry stale, so the next hit serves it one last
+        time and refreshes it in the background.  Falls back to deleting
+        entries that have no soft timeout."""
+        rv = self.cache.get(key)
+        if not isinstance(rv, CacheEntry):
+            return self.cache.delete(key)
+        timeout = max(rv.expires - time.time(), 1) if rv.expires else 0
+        return self.cache.set(key, rv._replace(fresh_until=0), timeout=timeout)
+
+    def invalidate_tag(self, *tags):
+        """Invalidate every entry carrying one of ``tags``."""
+        self.cache.set_many(dict(('tag/%s' % tag, uuid.uuid4().hex) for tag in tags), timeout=0)
+
+    def _tag_versions(self, tags):
+        keys = ['tag/%s' % tag for tag in tags]
+        versions = self.cache.get_many(*keys)
+        for i, version in enumerate(versions):
+            if version is None:
+                # first use, or the version itself was evicted: a new random
+                # version can't match an entry written before
+                self.cache.add(keys[i], uuid.uuid4().hex, timeout=0)
+                versions[i] = self.cache.get(keys[i])
+        return tuple(zip(tags, versions))
+
+    def cached(self, timeout=None, key_prefix='view/%s', unless=None, response_filter=None,
+               query_string=False, lock_timeout=10, soft_timeout=None, tags=None, conditional=False, compress=False,
+               **kwargs):
+        """Like :meth:`flask_caching.Cache.cached`, plus ``lock_timeout``,
+        ``soft_timeout``, ``tags`` (a list, or a callable taking the
+        function's arguments and returning one), ``conditional`` and
+        ``compress``.
+
+        With ``conditional``, pages are sent with an ETag and a
+        Last-Modified date computed when they were cached, and a request
+        that already has the cached version gets a 304 without the page
+        being rendered or hashed again.  ``compress`` implies it, and also
+        stores gzip and brotli variants of pages over
+        ``CACHE_COMPRESS_MIN_SIZE`` bytes next to the page, to be sent to
+        clients accepting them."""
+        make_decorator = super(Cache, self).cached(timeout=timeout, key_prefix=key_prefix, unless=unless,
+                                                   query_string=query_string, **kwargs)
+
+        def decorator(f):
+            # only borrowed for its cache key logic
+            keyed = make_decorator(f)
+
+            @functools.wraps(f)
+            def decorated_function(*args, **kw):
+                if self._bypass_cache(unless, f, *args, **kw):
+                    return f(*args, **kw)
+                key = keyed.make_cache_key(*args, **dict(kw))
+                rv = self._get_or_compute(key, lambda: f(*args, **kw), dict(
+                    timeout=decorated_function.cache_timeout, lock_timeout=lock_timeout,
+                    soft_timeout=soft_timeout, response_filter=response_filter,
+                    tags=tags(*args, **kw) if callable(tags) else tags,
+                    conditional=conditional or compress, compress=compress))
+                if isinstance(rv, Validated):
+                    return self._validated_response(rv)
+                return rv
+
+            decorated_function.uncached = f
+            decorated_function.cache_timeout = timeout
+            decorated_function.make_cache_key = keyed.make_cache_key
+            return decorated_function
+
+        return decorator
+
+    def memoize(self, timeout=None, make_name=None, unless=None, response_filter=None,
+                lock_timeout=10, soft_timeout=None, tags=None, key_builder=None, **kwargs):
+        """Like :meth:`flask_caching.Cache.memoize`, plus ``lock_timeout``,
+        ``soft_timeout``, ``tags`` and ``key_builder`` (e.g. a
+        :class:`KeyBuilder`) to replace Flask-Caching's argument hashing."""
+        make_decorator = super(Cache, self).memoize(timeout=timeout, make_name=make_name, unless=unless,
+                                                    **kwargs)
+
+        def decorator(f):
+            keyed = make_decorator(f)
+
+            @functools.wraps(f)
+            def decorated_function(*args, **kw):
+                if self._bypass_cache(unless, f, *args, **kw):
+                    return f(*args, **kw)
+                key = decorated_function.make_cache_key(f, *args, **kw)
+                return self._get_or_compute(key, lambda: f(*args, **kw), dict(
+                    timeout=decorated_function.cache_timeout, lock_timeout=lock_timeout,
+                    soft_timeout=soft_timeout, response_filter=response_filter,
+                    tags=tags(*args, **kw) if callable(tags) else tags))
+
+            def make_cache_key(f, *args, **kw):
+                # keep the per-function version, delete_memoized() relies on it
+                fname, version = self._memoize_version(f, args=args, timeout=decorated_function.cache_timeout)
+                return key_builder(f, args, kw) + version
+
+            decorated_function.uncached = f
+            decorated_function.cache_timeout = timeout
+            decorated_function.make_cache_key = keyed.make_cache_key if key_builder is None else make_cache_key
+            return decorated_function
+
+        return decorator
+
+    def _lookup(self, key):
+        """Return ``(value, stale)``, value is None on a miss or when one of
+        the entry's tags was invalidated."""
+        rv = self.cache.get(key)
+        if not isinstance(rv, CacheEntry):
+            return rv, False
+        if rv.tags and self._tag_versions([tag for tag, version in rv.tags]) != rv.tags:
+            return None, False
+        return rv.value, rv.fresh_until is not None and rv.fresh_until <= time.time()
+
+    def _compute_and_store(self, key, compute, options):
+        # read the tag versions first, an invalidation during compute() must
+        # win over what we are about to store
+        tags = self._tag_versions(options['tags']) if options['tags'] else ()
+        rv = compute()
+        self.computations[key] += 1
+        if options['response_filter'] is not None and not options['response_filter'](rv):
+            return rv
+        if options.get('conditional') and isinstance(rv, (str, bytes)):
+            body = rv.encode('utf-8') if isinstance(rv, str) else rv
+            variants = self._compress(body) if options.get('compress') else {}
+            # whole seconds, that's all Last-Modified can tell
+            rv = Validated(rv, fast_hash(body), int(time.time()), variants)
+        timeout = options['timeout']
+        if options['soft_timeout'] is not None or tags:
+            now = time.time()
+            hard_timeout = self.cache.default_timeout if timeout is None else timeout
+            fresh_until = now + options['soft_timeout'] if options['soft_timeout'] is not None else None
+            self.cache.set(key, CacheEntry(rv, fresh_until, now + hard_timeout if hard_timeout else 0, tags),
+                           timeout=timeout)
+        else:
+            self.cache.set(key, rv, timeout=timeout)
+        return rv
+
+    def _compress(self, body):
+        if len(body) < current_app.config.get('CACHE_COMPRESS_MIN_SIZE', 500):
+            return {}
+        variants = {}
+        for encoding, level in current_app.config.get('CACHE_COMPRESS_LEVELS', {'br': 4, 'gzip': 6}).items():
+            if encoding == 'gzip':
+                data = gzip.compress(body, level, mtime=0)
+            elif encoding == 'br' and brotli is not None:
+                data = brotli.compress(body, quality=level)
+            else:
+                continue
+            variants[encoding] = (data, fast_hash(data))
+        return variants
+
+    def _validated_response(self, entry):
+        body, etag = entry.body, entry.etag
+        for encoding in 'br', 'gzip':
+            if encoding in entry.variants and request.accept_encodings[encoding]:
+                body, etag = entry.variants[encoding]
+                break
+        else:
+            encoding = None
+        response = make_response(body)
+        if encoding is not None:
+            response.headers['Content-Encoding'] = encoding
+        if entry.variants:
+            response.vary.add('Accept-Encoding')
+        response.set_etag(etag)
+        response.last_modified = entry.last_modified
+        return response.make_conditional(request)
+
+    def _get_or_compute(self, key, compute, options):
+        rv, stale = self._lookup(key)
+        if stale:
+            self._refresh_in_background(key, compute, options)
+        if rv is not None:
+            return rv
+
+        lock_key = 'lock/%s' % key
+        lock_timeout = options['lock_timeout']
+        deadline = time.time() + lock_timeout
+        while True:
+            if self.cache.add(lock_key, True, timeout=lock_timeout):
+                try:
+                    # it may have been filled between our miss and the lock
+                    rv, stale = self._lookup(key)
+                    if rv is None:
+                        rv = self._compute_and_store(key, compute, options)
+                    return rv
+                finally:
+                    self.cache.delete(lock_key)
+
+            # somebody else is computing it
+            time.sleep(self.poll_interval)
+            rv, stale = self._lookup(key)
+            if rv is not None:
+                return rv
+            if time.time() > deadline:
+                # the lock holder is stuck, don't wait forever
+                return compute()
+
+    def _refresh_in_background(self, key, compute, options):
+        lock_key = 'lock/%s' % key
+        if not self.cache.add(lock_key, True, timeout=options['lock_timeout']):
+            return  # a refresh is already running
+        app = current_app._get_current_object()
+        # views need a request to render, so replay this one in the worker
+        environ = request.environ.copy() if has_request_context() else None
+
+        def refresh():
+            try:
+                with app.request_context(environ) if environ is not None else app.app_context():
+                    self._compute_and_store(key, compute, options)
+            except Exception:
+                app.logger.exception('Refreshing cache key %s failed.', key)
+            finally:
+                self.cache.delete(lock_key)
+
+        self.executor.submit(refresh)
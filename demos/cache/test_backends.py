@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+"""
+    :author: Grey Li (李辉)
+    :url: http://greyli.com
+    :copyright: © 2018 Grey Li
+    :license: MIT, see LICENSE for more details.
+"""
+import time
+import unittest
+
+from backends import LRUCache, TwoTierCache
+
+try:
+    import fakeredis
+except ImportError:
+    fakeredis = None
+
+
+class LRUCacheTestCase(unittest.TestCase):
+
+    def test_oversized_set_drops_old_value(self):
+        cache = LRUCache(max_bytes=100)
+        self.assertTrue(cache.set('page', 'small'))
+        self.assertFalse(cache.set('page', 'x' * 200))
+        self.assertIsNone(cache.get('page'))
+        self.assertEqual(cache.stats()['bytes'], 0)
+
+
+@unittest.skipIf(fakeredis is None, 'no fakeredis module found')
+class TwoTierCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        server = fakeredis.FakeServer()
+        # two workers sharing one Redis
+        self.first = TwoTierCache(fakeredis.FakeStrictRedis(server=server), l1_timeout=0.1)
+        self.second = TwoTierCache(fakeredis.FakeStrictRedis(server=server), l1_timeout=0.1)
+
+    def test_add_without_timeout_never_expires(self):
+        self.assertTrue(self.first.add('tag/post', 'v1', timeout=0))
+        self.assertEqual(self.first.client.ttl('tag/post'), -1)
+        time.sleep(0.2)  # past the L1 timeout
+        self.assertEqual(self.first.get('tag/post'), 'v1')
+
+    def test_tag_version_shared_between_workers(self):
+        self.assertTrue(self.first.add('tag/post', 'v1', timeout=0))
+        self.assertFalse(self.second.add('tag/post', 'v2', timeout=0))
+        time.sleep(0.2)
+        self.assertEqual(self.first.get('tag/post'), 'v1')
+        self.assertEqual(self.second.get('tag/post'), 'v1')
+
+    def test_add_with_timeout(self):
+        self.assertTrue(self.first.add('lock', True, timeout=10))
+        self.assertFalse(self.second.add('lock', True, timeout=10))
+        self.assertTrue(0 < self.first.client.ttl('lock') <= 10)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -5,16 +5,28 @@
     :copyright: © 2018 Grey Li
     :license: MIT, see LICENSE for more details.
 """
+import csv
+import json
 import os
+import random
+import shutil
 import sys
+import tempfile
+import threading
+import time
+from itertools import islice
 
 import click
 from flask import Flask
-from flask import redirect, url_for, abort, render_template, flash
-from flask_sqlalchemy import SQLAlchemy
+from flask import redirect, url_for, abort, render_template, flash, request, Markup, escape
+from flask_sqlalchemy import SQLAlchemy as _SQLAlchemy
 from flask_wtf import FlaskForm
 from wtforms import SubmitField, TextAreaField
 from wtforms.validators import DataRequired
+from sqlalchemy import create_engine
+from sqlalchemy.exc import OperationalError, SQLAlchemyError
+from sqlalchemy.orm import Session
+from sqlalchemy.pool import NullPool, QueuePool
 
 # SQLite URI compatible
 WIN = sys.platform.startswith('win')
@@ -32,6 +44,81 @@ app.config['SECRET_KEY'] = os.getenv('SECRET_KEY', 'secret string')
 app.config['SQLALCHEMY_DATABASE_URI'] = os.getenv('DATABASE_URL', prefix + os.path.join(app.root_path, 'data.db'))
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 
+app.config['NOTES_PER_PAGE'] = 20
+# the index counts notes up to here, then shows e.g. "1000+ notes"
+app.config['NOTES_COUNT_LIMIT'] = 1000
+app.config['SEARCH_RESULTS_PER_PAGE'] = 20
+app.config['LISTING_PER_PAGE'] = 50
+
+# SQLite engine profiles
+# 'default' is what you get out of the box: a rollback journal, so a writer
+# blocks every reader, and NullPool, so each checkout opens a new connection
+# with a cold page cache.  'production' switches to WAL (readers and one
+# writer run concurrently), only fsyncs at checkpoints, memory-maps the file,
+# waits on locks instead of failing, and keeps connections in a pool.
+SQLITE_PROFILES = {
+    'default': {
+        # SQLite only enforces foreign keys (and ON DELETE CASCADE) when asked to
+        'pragmas': {'foreign_keys': 'ON'},
+        'engine_options': {'poolclass': NullPool},
+    },
+    'production': {
+        'pragmas': {
+            'foreign_keys': 'ON',
+            'journal_mode': 'WAL',
+            'synchronous': 'NORMAL',
+            'mmap_size': 256 * 1024 * 1024,
+            'cache_size': -64 * 1024,  # negative means KiB, i.e. 64 MiB
+            'busy_timeout': 5000,  # ms
+        },
+        'engine_options': {
+            'poolclass': QueuePool,
+            'pool_size': 10,
+            'max_overflow': 20,
+            # pooled connections are handed from thread to thread
+            'connect_args': {'check_same_thread': False},
+        },
+    },
+}
+
+app.config['SQLITE_PROFILE'] = os.getenv('SQLITE_PROFILE', 'production')
+
+
+def is_sqlite_file(uri):
+    return uri.startswith('sqlite:') and uri.rstrip('/') != 'sqlite:' and ':memory:' not in uri
+
+
+if is_sqlite_file(app.config['SQLALCHEMY_DATABASE_URI']):
+    # in-memory databases keep Flask-SQLAlchemy's single shared connection
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = SQLITE_PROFILES[app.config['SQLITE_PROFILE']]['engine_options']
+
+
+def use_sqlite_pragmas(engine, pragmas):
+    """Run ``PRAGMA name=value`` for each pragma on every new connection."""
+    @db.event.listens_for(engine, 'connect')
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute('PRAGMA %s=%s' % (name, value))
+        cursor.close()
+
+
+def create_sqlite_engine(uri, profile):
+    options = SQLITE_PROFILES[profile]
+    engine = create_engine(uri, **options['engine_options'])
+    use_sqlite_pragmas(engine, options['pragmas'])
+    return engine
+
+
+class SQLAlchemy(_SQLAlchemy):
+    def create_engine(self, sa_url, engine_opts):
+        engine = super(SQLAlchemy, self).create_engine(sa_url, engine_opts)
+        if engine.dialect.name == 'sqlite':
+            use_sqlite_pragmas(engine, SQLITE_PROFILES[app.config['SQLITE_PROFILE']]['pragmas'])
+            db.event.listen(engine, 'first_connect', create_search_tables)
+        return engine
+
+
 db = SQLAlchemy(app)
 
 
@@ -40,17 +127,22 @@ db = SQLAlchemy(app)
 def make_shell_context():
     return dict(db=db, Note=Note, Author=Author, Article=Article, Writer=Writer, Book=Book,
                 Singer=Singer, Song=Song, Citizen=Citizen, City=City, Capital=Capital,
-                Country=Country, Teacher=Teacher, Student=Student, Post=Post, Comment=Comment, Draft=Draft)
+                Country=Country, Teacher=Teacher, Student=Student, Post=Post, Comment=Comment, Draft=Draft,
+                DraftEditLog=DraftEditLog)
 
 
 @app.cli.command()
 @click.option('--drop', is_flag=True, help='Create after drop.')
-def initdb(drop):
+@click.option('--reindex', is_flag=True, help='Rebuild the full-text search index.')
+def initdb(drop, reindex):
     """Initialize the database."""
     if drop:
         db.drop_all()
     db.create_all()
     click.echo('Initialized database.')
+    if reindex:
+        rebuild_search_index()
+        click.echo('Rebuilt search index.')
 
 
 # Forms
@@ -78,11 +170,75 @@ class Note(db.Model):
         return '<Note %r>' % self.body
 
 
+class NotePage(object):
+    """One page of notes fetched with the seek method (keyset pagination).
+
+    Rather than ``OFFSET``, which makes the database walk and discard every
+    skipped row, each page continues from the primary key of the last (or
+    first) note on the current page, so fetching page 1000 costs the same as
+    fetching page 1.
+    """
+
+    def __init__(self, items, prev_cursor=None, next_cursor=None):
+        self.items = items
+        self.prev_cursor = prev_cursor
+        self.next_cursor = next_cursor
+
+    @property
+    def has_prev(self):
+        return self.prev_cursor is not None
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+
+def paginate_notes(after=None, before=None, per_page=None):
+    """Return a :class:`NotePage` of notes ordered by id.
+
+    :param after: only return notes whose id is greater than this cursor.
+    :param before: only return notes whose id is less than this cursor,
+                   used when walking backwards.
+    :param per_page: page size, defaults to ``NOTES_PER_PAGE``.
+    """
+    per_page = per_page or app.config['NOTES_PER_PAGE']
+    query = Note.query
+    if before is not None:
+        # walk backwards, then flip the rows back into ascending order
+        rows = query.filter(Note.id < before).order_by(Note.id.desc()).limit(per_page + 1).all()
+        has_more = len(rows) > per_page
+        items = list(reversed(rows[:per_page]))
+        has_prev, has_next = has_more, True
+    else:
+        if after is not None:
+            query = query.filter(Note.id > after)
+        rows = query.order_by(Note.id).limit(per_page + 1).all()
+        has_more = len(rows) > per_page
+        items = rows[:per_page]
+        has_prev, has_next = after is not None, has_more
+    # fetching one extra row tells us whether there is another page
+    # without a second query
+    prev_cursor = items[0].id if items and has_prev else None
+    next_cursor = items[-1].id if items and has_next else None
+    return NotePage(items, prev_cursor=prev_cursor, next_cursor=next_cursor)
+
+
+def count_notes(limit=None):
+    """Count the notes, but no more than ``limit`` (``NOTES_COUNT_LIMIT``)
+    plus one, so the index costs the same however many notes there are; a
+    count over the limit means "more than that"."""
+    limit = limit or app.config['NOTES_COUNT_LIMIT']
+    ids = db.session.query(Note.id).limit(limit + 1).subquery()
+    return db.session.query(db.func.count()).select_from(ids).scalar()
+
+
 @app.route('/')
 def index():
     form = DeleteNoteForm()
-    notes = Note.query.all()
-    return render_template('index.html', notes=notes, form=form)
+    page = paginate_notes(after=request.args.get('after', type=int),
+                          before=request.args.get('before', type=int))
+    return render_template('index.html', notes=page.items, page=page,
+                           total=count_notes(), form=form)
 
 
 @app.route('/new', methods=['GET', 'POST'])
@@ -98,15 +254,39 @@ def new_note():
     return render_template('new_note.html', form=form)
 
 
+# Note mutations go straight to UPDATE/DELETE ... WHERE id=? and use the
+# rowcount to tell whether the note existed, instead of loading it into the
+# session first. Query.update()/delete() skip the mapper events, so the search
+# index is kept in sync here.
+def update_note(note_id, body):
+    """Update a note's body in one statement, return False if it doesn't exist."""
+    updated = Note.query.filter_by(id=note_id).update({'body': body}, synchronize_session=False)
+    connection = db.session.connection()
+    if updated and connection.dialect.name == 'sqlite':
+        _index_entry(connection, 'note', note_id, body)
+    db.session.commit()
+    return bool(updated)
+
+
+def remove_note(note_id):
+    """Delete a note in one statement, return False if it doesn't exist."""
+    deleted = Note.query.filter_by(id=note_id).delete(synchronize_session=False)
+    connection = db.session.connection()
+    if deleted and connection.dialect.name == 'sqlite':
+        _unindex_entry(connection, 'note', note_id)
+    db.session.commit()
+    return bool(deleted)
+
+
 @app.route('/edit/<int:note_id>', methods=['GET', 'POST'])
 def edit_note(note_id):
     form = EditNoteForm()
-    note = Note.query.get(note_id)
     if form.validate_on_submit():
-        note.body = form.body.data
-        db.session.commit()
+        if not update_note(note_id, form.body.data):
+            abort(404)
         flash('Your note is updated.')
         return redirect(url_for('index'))
+    note = Note.query.with_entities(Note.body).filter_by(id=note_id).first_or_404()
     form.body.data = note.body  # preset form input's value
     return render_template('edit_note.html', form=form)
 
@@ -115,9 +295,8 @@ def edit_note(note_id):
 def delete_note(note_id):
     form = DeleteNoteForm()
     if form.validate_on_submit():
-        note = Note.query.get(note_id)
-        db.session.delete(note)
-        db.session.commit()
+        if not remove_note(note_id):
+            abort(404)
         flash('Your note is deleted.')
     else:
         abort(400)
@@ -259,30 +438,663 @@ class Post(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String(50))
     body = db.Column(db.Text)
-    comments = db.relationship('Comment', back_populates='post', cascade='all, delete-orphan')  # collection
+    # passive_deletes leaves unloaded comments to the database's ON DELETE CASCADE
+    # instead of loading them all just to delete them one by one
+    comments = db.relationship('Comment', back_populates='post', cascade='all, delete-orphan',
+                               passive_deletes=True)  # collection
 
 
 class Comment(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     body = db.Column(db.Text)
-    post_id = db.Column(db.Integer, db.ForeignKey('post.id'))
+    post_id = db.Column(db.Integer, db.ForeignKey('post.id', ondelete='CASCADE'), index=True)
     post = db.relationship('Post', back_populates='comments')  # scalar
 
 
+def delete_posts(ids, session=None):
+    """Delete posts and their comments with set-based DELETE statements,
+    without loading anything into the session. Returns the number of posts
+    deleted.
+
+    Comments are deleted explicitly rather than through ON DELETE CASCADE, so
+    this also works on connections that don't enforce foreign keys.
+    """
+    session = session or db.session
+    ids = list(ids)
+    deleted = 0
+    # stay under SQLite's limit on bound parameters per statement
+    for start in range(0, len(ids), 500):
+        chunk = ids[start:start + 500]
+        session.query(Comment).filter(Comment.post_id.in_(chunk)).delete(synchronize_session=False)
+        deleted += session.query(Post).filter(Post.id.in_(chunk)).delete(synchronize_session=False)
+    session.commit()
+    return deleted
+
+
 # event listening
+# Edits are counted in memory on the instance and written once per flush as
+# an atomic "edit_time = edit_time + n", so concurrent editors never lose
+# increments and a draft edited many times between flushes costs one UPDATE.
+# With DRAFT_EDIT_LOG enabled the increments are appended to draft_edit_log
+# instead, keeping writers off the hot draft row, and folded into edit_time
+# by "flask compact-edits".
+app.config['DRAFT_EDIT_LOG'] = False
+
+
 class Draft(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     body = db.Column(db.Text)
     edit_time = db.Column(db.Integer, default=0)
 
 
+class DraftEditLog(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    draft_id = db.Column(db.Integer, db.ForeignKey('draft.id', ondelete='CASCADE'), index=True, nullable=False)
+    count = db.Column(db.Integer, nullable=False)
+
+
 @db.event.listens_for(Draft.body, 'set')
 def increment_edit_time(target, value, oldvalue, initiator):
-    if target.edit_time is not None:
-        target.edit_time += 1
+    # like before, only edits to a saved draft count
+    if db.inspect(target).has_identity:
+        target.pending_edits = getattr(target, 'pending_edits', 0) + 1
 
 # same with:
 # @db.event.listens_for(Draft.body, 'set', named=True)
 # def increment_edit_time(**kwargs):
-#     if kwargs['target'].edit_time is not None:
-#         kwargs['target'].edit_time += 1
+#     if db.inspect(kwargs['target']).has_identity:
+#         kwargs['target'].pending_edits = getattr(kwargs['target'], 'pending_edits', 0) + 1
+
+
+@db.event.listens_for(db.session, 'after_flush')
+def write_edit_time(session, flush_context):
+    edits = [(draft, draft.pending_edits) for draft in session.dirty
+             if isinstance(draft, Draft) and getattr(draft, 'pending_edits', 0)]
+    if not edits:
+        return
+    if app.config['DRAFT_EDIT_LOG']:
+        session.execute(DraftEditLog.__table__.insert(),
+                        [{'draft_id': draft.id, 'count': count} for draft, count in edits])
+    else:
+        table = Draft.__table__
+        session.execute(table.update().where(table.c.id == db.bindparam('draft_id'))
+                        .values(edit_time=db.func.coalesce(table.c.edit_time, 0) + db.bindparam('count')),
+                        [{'draft_id': draft.id, 'count': count} for draft, count in edits])
+    for draft, count in edits:
+        draft.pending_edits = 0
+    session.info.setdefault('edited_drafts', []).extend(draft for draft, count in edits)
+
+
+@db.event.listens_for(db.session, 'after_flush_postexec')
+def expire_edit_time(session, flush_context):
+    # the in-memory value is stale now, reload it on next access
+    for draft in session.info.pop('edited_drafts', []):
+        session.expire(draft, ['edit_time'])
+
+
+def count_edits(draft_id):
+    """Exact number of edits of a draft, including uncompacted log entries."""
+    logged = db.session.query(db.func.coalesce(db.func.sum(DraftEditLog.count), 0)) \
+        .filter(DraftEditLog.draft_id == draft_id).scalar()
+    # drafts saved before edits were counted have a NULL edit_time
+    return db.session.query(db.func.coalesce(Draft.edit_time, 0)).filter(Draft.id == draft_id).scalar() + logged
+
+
+def compact_edit_log():
+    """Fold the edit log into draft.edit_time and truncate it, in one
+    transaction. Returns the number of log entries compacted."""
+    log = DraftEditLog.__table__
+    draft = Draft.__table__
+    with db.engine.begin() as connection:
+        # only compact what is there now, entries appended meanwhile wait
+        # for the next run
+        last_id = connection.execute(db.select([db.func.max(log.c.id)])).scalar()
+        if last_id is None:
+            return 0
+        logged = db.select([db.func.sum(log.c.count)]) \
+            .where(log.c.draft_id == draft.c.id).where(log.c.id <= last_id).as_scalar()
+        connection.execute(draft.update()
+                           .where(draft.c.id.in_(db.select([log.c.draft_id]).where(log.c.id <= last_id)))
+                           .values(edit_time=db.func.coalesce(draft.c.edit_time, 0) + logged))
+        return connection.execute(log.delete().where(log.c.id <= last_id)).rowcount
+
+
+@app.cli.command('compact-edits')
+def compact_edits():
+    """Fold the draft edit log into the edit counters (run it periodically)."""
+    click.echo('Compacted %d edit log entries.' % compact_edit_log())
+
+
+@app.cli.command('check-edit-counter')
+@click.option('--threads', default=8, help='Concurrent editors.')
+@click.option('--edits', default=50, help='Edits per editor, committed one at a time.')
+def check_edit_counter(threads, edits):
+    """Edit one draft from many threads and check no increment is lost."""
+    draft = Draft(body='')
+    db.session.add(draft)
+    db.session.commit()
+    draft_id = draft.id
+
+    def edit(n):
+        with app.app_context():
+            for i in range(edits):
+                # a fresh load every time, so a lost update would show
+                Draft.query.get(draft_id).body = 'editor %d edit %d' % (n, i)
+                db.session.commit()
+                db.session.remove()
+
+    workers = [threading.Thread(target=edit, args=(n,)) for n in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    counted = count_edits(draft_id)
+    db.session.delete(db.session.merge(draft))
+    db.session.commit()
+    click.echo('%d edits, %d counted.' % (threads * edits, counted))
+    if counted != threads * edits:
+        raise click.ClickException('Edits were lost.')
+
+
+# full-text search
+# Each searchable model gets an SQLite FTS5 table whose rowid is the model's
+# primary key, kept in sync by mapper events, so a search is an index lookup
+# instead of a LIKE '%x%' scan over the text columns.
+SEARCHABLE = {'note': 'note_fts', 'article': 'article_fts'}
+
+for _table, _fts_table in SEARCHABLE.items():
+    db.event.listen(db.metadata, 'after_create',
+                    db.DDL('CREATE VIRTUAL TABLE IF NOT EXISTS %s USING fts5(body)' % _fts_table)
+                    .execute_if(dialect='sqlite'))
+    db.event.listen(db.metadata, 'before_drop',
+                    db.DDL('DROP TABLE IF EXISTS %s' % _fts_table).execute_if(dialect='sqlite'))
+
+
+def create_search_tables(dbapi_connection, connection_record):
+    """Add the FTS tables to a database created before search existed (the
+    mapper events write to them on every insert), filled from their model
+    tables."""
+    tables = set(row[0] for row in dbapi_connection.execute("SELECT name FROM sqlite_master WHERE type = 'table'"))
+    for table, fts_table in SEARCHABLE.items():
+        if fts_table in tables:
+            continue
+        dbapi_connection.execute('CREATE VIRTUAL TABLE IF NOT EXISTS %s USING fts5(body)' % fts_table)
+        if table in tables:
+            dbapi_connection.execute('INSERT INTO %s (rowid, body) SELECT id, body FROM %s WHERE body IS NOT NULL'
+                                     % (fts_table, table))
+    dbapi_connection.commit()
+
+
+def _index_entry(connection, table, id, body):
+    _unindex_entry(connection, table, id)
+    if body is not None:
+        connection.execute(db.text('INSERT INTO %s (rowid, body) VALUES (:id, :body)' % SEARCHABLE[table]),
+                           id=id, body=body)
+
+
+def _unindex_entry(connection, table, id):
+    connection.execute(db.text('DELETE FROM %s WHERE rowid = :id' % SEARCHABLE[table]), id=id)
+
+
+@db.event.listens_for(Note, 'after_insert')
+@db.event.listens_for(Article, 'after_insert')
+def index_on_insert(mapper, connection, target):
+    if connection.dialect.name == 'sqlite':
+        _index_entry(connection, target.__tablename__, target.id, target.body)
+
+
+@db.event.listens_for(Note, 'after_update')
+@db.event.listens_for(Article, 'after_update')
+def index_on_update(mapper, connection, target):
+    # skip the index write when an update does not touch the body
+    if connection.dialect.name == 'sqlite' and db.inspect(target).attrs.body.history.has_changes():
+        _index_entry(connection, target.__tablename__, target.id, target.body)
+
+
+@db.event.listens_for(Note, 'after_delete')
+@db.event.listens_for(Article, 'after_delete')
+def index_on_delete(mapper, connection, target):
+    if connection.dialect.name == 'sqlite':
+        _unindex_entry(connection, target.__tablename__, target.id)
+
+
+def rebuild_search_index():
+    """Rebuild every FTS table from its model table with one set-based
+    INSERT ... SELECT per table, then merge the index b-trees."""
+    with db.engine.begin() as connection:
+        for table, fts_table in SEARCHABLE.items():
+            connection.execute('DELETE FROM %s' % fts_table)
+            connection.execute('INSERT INTO %s (rowid, body) SELECT id, body FROM %s WHERE body IS NOT NULL'
+                               % (fts_table, table))
+            connection.execute("INSERT INTO %s (%s) VALUES ('optimize')" % (fts_table, fts_table))
+
+
+def _match_expression(q):
+    # quote every term so user input can never be parsed as FTS5 query syntax
+    return ' '.join('"%s"' % term.replace('"', '""') for term in q.split())
+
+
+def search(q, page=1, per_page=None):
+    """Search notes and articles, best matches (lowest bm25 rank) first.
+
+    Returns a list of ``(kind, id, snippet)`` tuples plus a flag telling
+    whether there is another page.
+    """
+    per_page = per_page or app.config['SEARCH_RESULTS_PER_PAGE']
+    selects = ["SELECT '%s' AS kind, rowid AS id, "
+               "snippet(%s, 0, char(2), char(3), '...', 16) AS snippet, rank "
+               "FROM %s WHERE %s MATCH :q" % (table, fts_table, fts_table, fts_table)
+               for table, fts_table in SEARCHABLE.items()]
+    sql = ' UNION ALL '.join(selects) + ' ORDER BY rank LIMIT :limit OFFSET :offset'
+    rows = db.session.execute(db.text(sql), dict(q=_match_expression(q), limit=per_page + 1,
+                                                 offset=(page - 1) * per_page)).fetchall()
+    results = [(row.kind, row.id, _highlight(row.snippet)) for row in rows[:per_page]]
+    return results, len(rows) > per_page
+
+
+def _highlight(snippet):
+    # FTS5 wraps matches in control characters that can't appear in a note,
+    # so the text can be escaped first and the markers turned into tags after
+    return Markup(escape(snippet).replace('\x02', Markup('<mark>')).replace('\x03', Markup('</mark>')))
+
+
+@app.route('/search')
+def search_notes():
+    q = request.args.get('q', '').strip()
+    page = request.args.get('page', 1, type=int)
+    results, has_next = search(q, page) if q else ([], False)
+    return render_template('search.html', q=q, results=results, page=page, has_next=has_next)
+
+
+# bulk import/export
+# Rows go through Core insert() with a list of parameter sets, which the
+# driver runs as a single executemany per batch, and are read back with a
+# streaming cursor, so memory use depends on --batch-size, not on table size.
+BULK_TABLES = ['note', 'author', 'article', 'student', 'teacher', 'association']
+
+
+def _guess_format(filename, fmt):
+    if fmt:
+        return fmt
+    return 'csv' if filename.endswith('.csv') else 'jsonl'
+
+
+def _read_rows(f, fmt):
+    """Yield ``(number, row)`` for each row of the file, the row is None
+    when it can't be read as one."""
+    if fmt == 'csv':
+        for number, row in enumerate(csv.DictReader(f), 1):
+            # csv has no null, treat empty cells as NULL
+            yield number, dict((key, value if value != '' else None) for key, value in row.items())
+    else:
+        for number, line in enumerate(f, 1):
+            if line.strip():
+                try:
+                    row = json.loads(line)
+                except ValueError:
+                    row = None
+                yield number, row if isinstance(row, dict) else None
+
+
+def _insert_batch(table, batch):
+    """Insert ``(number, row)`` pairs and commit, return the numbers of the
+    rows that were refused."""
+    # executemany takes its bind parameters from the first row, so rows
+    # with different columns go in separate statements, leaving the rest to
+    # the column defaults
+    groups = {}
+    for number, row in batch:
+        groups.setdefault(frozenset(row), []).append((number, row))
+    try:
+        for rows in groups.values():
+            db.session.execute(table.insert(), [row for number, row in rows])
+        db.session.commit()
+        return []
+    except SQLAlchemyError:
+        db.session.rollback()
+    # find the culprits one row at a time
+    refused = []
+    for number, row in batch:
+        try:
+            db.session.execute(table.insert(), row)
+            db.session.commit()
+        except SQLAlchemyError as e:
+            db.session.rollback()
+            refused.append((number, e.orig if getattr(e, 'orig', None) is not None else e))
+    return refused
+
+
+def _report(action, count, started):
+    elapsed = time.time() - started
+    # report on stderr so exporting to stdout keeps the data clean
+    click.echo('%s %d rows in %.2fs (%d rows/sec).' % (action, count, elapsed, count / elapsed if elapsed else 0),
+               err=True)
+
+
+@app.cli.command('import-notes')
+@click.argument('f', type=click.File('r'))
+@click.option('--table', type=click.Choice(BULK_TABLES), default='note', help='Table to import into.')
+@click.option('--format', 'fmt', type=click.Choice(['jsonl', 'csv']), help='Defaults to the file extension.')
+@click.option('--batch-size', default=1000, help='Rows per INSERT batch and commit.')
+def import_notes(f, table, fmt, batch_size):
+    """Import rows from a JSONL or CSV file.
+
+    Unknown columns are ignored; rows that can't be read or inserted are
+    reported and skipped, the others are imported.
+    """
+    table = db.metadata.tables[table]
+    columns = set(table.columns.keys())
+    count = skipped = 0
+    started = time.time()
+    rows = _read_rows(f, _guess_format(f.name, fmt))
+    while True:
+        chunk = list(islice(rows, batch_size))
+        if not chunk:
+            break
+        batch = []
+        for number, row in chunk:
+            if row is None:
+                click.echo('Row %d skipped: not a row.' % number, err=True)
+                skipped += 1
+            else:
+                batch.append((number, dict((key, value) for key, value in row.items() if key in columns)))
+        refused = _insert_batch(table, batch) if batch else []
+        for number, error in refused:
+            click.echo('Row %d skipped: %s' % (number, error), err=True)
+        count += len(batch) - len(refused)
+        skipped += len(refused)
+    # Core inserts skip the mapper events that keep the search index in sync
+    if table.name in SEARCHABLE:
+        rebuild_search_index()
+    _report('Imported', count, started)
+    if skipped:
+        click.echo('Skipped %d rows.' % skipped, err=True)
+
+
+@app.cli.command('export-notes')
+@click.argument('f', type=click.File('w'))
+@click.option('--table', type=click.Choice(BULK_TABLES), default='note', help='Table to export.')
+@click.option('--format', 'fmt', type=click.Choice(['jsonl', 'csv']), help='Defaults to the file extension.')
+@click.option('--batch-size', default=1000, help='Rows fetched per round trip.')
+def export_notes(f, table, fmt, batch_size):
+    """Export rows to a JSONL or CSV file ("-" for stdout)."""
+    table = db.metadata.tables[table]
+    fmt = _guess_format(f.name, fmt)
+    columns = table.columns.keys()
+    if fmt == 'csv':
+        writer = csv.writer(f)
+        writer.writerow(columns)
+    count = 0
+    started = time.time()
+    with db.engine.connect() as connection:
+        result = connection.execution_options(stream_results=True).execute(table.select())
+        while True:
+            batch = result.fetchmany(batch_size)
+            if not batch:
+                break
+            if fmt == 'csv':
+                writer.writerows(batch)
+            else:
+                f.writelines(json.dumps(dict(zip(columns, row))) + '\n' for row in batch)
+            count += len(batch)
+    _report('Exported', count, started)
+
+
+# relationship listings
+# Relationships keep the default lazy='select', which issues one query per
+# parent as soon as a list page touches the collection (the N+1 problem).
+# Listings pick a loader option per query instead: selectin loads all the
+# children with a second "WHERE parent_id IN (...)" query, joined folds them
+# into the parent query with a LEFT OUTER JOIN, and subquery re-runs the
+# parent query as a subquery, which suits the many-to-many association.
+LOADING_STRATEGIES = {
+    'lazy': db.lazyload,
+    'selectin': db.selectinload,
+    'joined': db.joinedload,
+    'subquery': db.subqueryload,
+}
+
+# statements a listing page may issue with each strategy, whatever the
+# number of rows; lazy is missing on purpose, it grows with the page
+EXPECTED_QUERIES = {'selectin': 2, 'joined': 1, 'subquery': 2}
+
+# listing name -> (model, collection attribute, default strategy)
+LISTINGS = {
+    'authors': (Author, 'articles', 'selectin'),
+    'writers': (Writer, 'books', 'selectin'),
+    'singers': (Singer, 'songs', 'selectin'),
+    'students': (Student, 'teachers', 'subquery'),
+    'teachers': (Teacher, 'students', 'subquery'),
+    'posts': (Post, 'comments', 'selectin'),
+}
+
+
+def load_listing(name, strategy=None, after=None):
+    """Return one page of parents for a listing, with their collection loaded
+    by ``strategy`` (defaults to the listing's own strategy)."""
+    model, attribute, default_strategy = LISTINGS[name]
+    loader = LOADING_STRATEGIES[strategy or default_strategy]
+    query = model.query.options(loader(getattr(model, attribute)))
+    if after is not None:
+        query = query.filter(model.id > after)
+    return query.order_by(model.id).limit(app.config['LISTING_PER_PAGE']).all()
+
+
+@app.route('/list/<any(%s):name>' % ', '.join(LISTINGS))
+def show_listing(name):
+    strategy = request.args.get('load')
+    if strategy is not None and strategy not in LOADING_STRATEGIES:
+        abort(400)
+    items = load_listing(name, strategy, after=request.args.get('after', type=int))
+    next_cursor = items[-1].id if len(items) == app.config['LISTING_PER_PAGE'] else None
+    return render_template('listing.html', name=name, attribute=LISTINGS[name][1],
+                           items=items, strategy=strategy, next_cursor=next_cursor)
+
+
+def count_queries(func, *args, **kwargs):
+    """Call ``func`` and return how many SQL statements it executed."""
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    db.event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        func(*args, **kwargs)
+    finally:
+        db.event.remove(db.engine, 'before_cursor_execute', before_cursor_execute)
+    return len(statements)
+
+
+@app.cli.command('check-queries')
+def check_queries():
+    """Fail if a listing page issues more queries than its loading strategy
+    allows, i.e. when an N+1 has crept in."""
+    # seed a few parents with children so a lazy load would actually show up,
+    # everything is rolled back at the end
+    for name, (model, attribute, _) in LISTINGS.items():
+        child_model = getattr(model, attribute).property.mapper.class_
+        for i in range(3):
+            parent = model(**{'title' if model is Post else 'name': 'check-queries-%s-%d' % (name, i)})
+            getattr(parent, attribute).extend(
+                child_model(**{'body' if child_model is Comment else
+                               'title' if child_model is Article else 'name':
+                               'check-queries-%s-%d-%d' % (name, i, j)})
+                for j in range(2))
+            db.session.add(parent)
+    db.session.flush()
+
+    failed = False
+    try:
+        for name in LISTINGS:
+            for strategy in sorted(LOADING_STRATEGIES):
+                db.session.expire_all()  # make every page start cold
+
+                def render():
+                    with app.test_request_context():
+                        render_template('listing.html', name=name, attribute=LISTINGS[name][1],
+                                        items=load_listing(name, strategy), strategy=strategy,
+                                        next_cursor=None)
+
+                count = count_queries(render)
+                expected = EXPECTED_QUERIES.get(strategy)
+                ok = expected is None or count <= expected
+                failed = failed or not ok
+                click.echo('%-9s %-9s %3d queries %s' % (name, strategy, count, '' if ok else
+                                                         'FAILED, expected at most %d' % expected))
+    finally:
+        db.session.rollback()
+    if failed:
+        raise click.ClickException('N+1 queries detected.')
+
+
+# SQLite profile benchmark
+@app.cli.command('bench-sqlite')
+@click.option('--readers', default=8, help='Reader threads.')
+@click.option('--writers', default=2, help='Writer threads.')
+@click.option('--seconds', default=5.0, help='Duration per profile.')
+@click.option('--rows', default=10000, help='Rows to seed before the run.')
+def bench_sqlite(readers, writers, seconds, rows):
+    """Compare concurrent read/write throughput of the SQLite profiles."""
+    for profile in sorted(SQLITE_PROFILES):
+        tmpdir = tempfile.mkdtemp()
+        engine = create_sqlite_engine('sqlite:///' + os.path.join(tmpdir, 'bench.db'), profile)
+        try:
+            Note.__table__.create(engine)
+            engine.execute(Note.__table__.insert(), [{'body': 'note %d' % i} for i in range(rows)])
+            counts = {'reads': 0, 'writes': 0, 'errors': 0}
+            lock = threading.Lock()
+            deadline = time.time() + seconds
+
+            def work(write):
+                done = errors = 0
+                while time.time() < deadline:
+                    try:
+                        if write:
+                            with engine.begin() as connection:
+                                connection.execute(Note.__table__.insert(), body='bench')
+                        else:
+                            with engine.connect() as connection:
+                                connection.execute(Note.__table__.select().where(
+                                    Note.id == random.randint(1, rows))).fetchall()
+                        done += 1
+                    except OperationalError:  # database is locked
+                        errors += 1
+                with lock:
+                    counts['writes' if write else 'reads'] += done
+                    counts['errors'] += errors
+
+            threads = [threading.Thread(target=work, args=(i < writers,)) for i in range(readers + writers)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            click.echo('%-10s %8d reads/sec %8d writes/sec %5d lock errors' % (
+                profile, counts['reads'] / seconds, counts['writes'] / seconds, counts['errors']))
+        finally:
+            engine.dispose()
+            shutil.rmtree(tmpdir)
+
+
+# post deletion benchmark
+@app.cli.command('bench-delete')
+@click.option('--comments', '-c', multiple=True, type=int, default=[10000, 100000],
+              help='Comments on the deleted post, can be given more than once.')
+def bench_delete(comments):
+    """Compare the ways of deleting a post with many comments."""
+
+    def orm(session, post_id):
+        # what delete-orphan did before passive_deletes: load every comment,
+        # then one DELETE per row
+        post = session.query(Post).get(post_id)
+        len(post.comments)
+        session.delete(post)
+        session.commit()
+
+    def passive(session, post_id):
+        session.delete(session.query(Post).get(post_id))
+        session.commit()
+
+    def bulk(session, post_id):
+        delete_posts([post_id], session=session)
+
+    for count in comments:
+        for name, method in (('orm', orm), ('passive', passive), ('bulk', bulk)):
+            tmpdir = tempfile.mkdtemp()
+            engine = create_sqlite_engine('sqlite:///' + os.path.join(tmpdir, 'bench.db'),
+                                          app.config['SQLITE_PROFILE'])
+            try:
+                db.metadata.create_all(engine, tables=[Post.__table__, Comment.__table__])
+                post_id = engine.execute(Post.__table__.insert(), title='bench').inserted_primary_key[0]
+                engine.execute(Comment.__table__.insert(), [{'body': 'comment', 'post_id': post_id}
+                                                            for _ in range(count)])
+                session = Session(bind=engine)
+                started = time.time()
+                method(session, post_id)
+                elapsed = time.time() - started
+                session.close()
+                left = engine.execute(db.select([db.func.count(Comment.id)])).scalar()
+                click.echo('%7d comments  %-8s %8.3fs  (%d comments left)' % (count, name, elapsed, left))
+            finally:
+                engine.dispose()
+                shutil.rmtree(tmpdir)
+
+
+# note mutation benchmark
+@app.cli.command('bench-notes')
+@click.option('--requests', 'count', default=1000, help='Requests per endpoint and path.')
+def bench_notes(count):
+    """Compare requests/sec of the note edit/delete views against the
+    load-then-mutate ORM versions they replaced."""
+
+    def orm_edit_note(note_id):
+        form = EditNoteForm()
+        note = Note.query.get(note_id)
+        if form.validate_on_submit():
+            note.body = form.body.data
+            db.session.commit()
+            flash('Your note is updated.')
+            return redirect(url_for('index'))
+        form.body.data = note.body
+        return render_template('edit_note.html', form=form)
+
+    def orm_delete_note(note_id):
+        form = DeleteNoteForm()
+        if form.validate_on_submit():
+            note = Note.query.get(note_id)
+            db.session.delete(note)
+            db.session.commit()
+            flash('Your note is deleted.')
+        else:
+            abort(400)
+        return redirect(url_for('index'))
+
+    app.add_url_rule('/bench/edit/<int:note_id>', 'orm_edit_note', orm_edit_note, methods=['POST'])
+    app.add_url_rule('/bench/delete/<int:note_id>', 'orm_delete_note', orm_delete_note, methods=['POST'])
+    # on a scratch database, and with the config put back afterwards
+    tmpdir = tempfile.mkdtemp()
+    saved = app.config['SQLALCHEMY_DATABASE_URI'], app.config.get('WTF_CSRF_ENABLED', True)
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(tmpdir, 'bench.db')
+    app.config['WTF_CSRF_ENABLED'] = False
+    try:
+        db.create_all()
+        # without cookies, so unread flash messages don't pile up in the session
+        client = app.test_client(use_cookies=False)
+
+        for label, edit_url, delete_url in (('orm', '/bench/edit/%d', '/bench/delete/%d'),
+                                            ('lean', '/edit/%d', '/delete/%d')):
+            last_id = db.session.query(db.func.coalesce(db.func.max(Note.id), 0)).scalar()
+            db.session.execute(Note.__table__.insert(), [{'body': 'bench'}] * count)
+            db.session.commit()
+            note_ids = range(last_id + 1, last_id + count + 1)
+            for action, url, data in (('edit', edit_url, {'body': 'edited'}), ('delete', delete_url, {})):
+                started = time.time()
+                for note_id in note_ids:
+                    client.post(url % note_id, data=data)
+                elapsed = time.time() - started
+                click.echo('%-4s %-6s %8.1f req/sec' % (label, action, count / elapsed))
+    finally:
+        db.session.remove()
+        db.get_engine().dispose()
+        app.config['SQLALCHEMY_DATABASE_URI'], app.config['WTF_CSRF_ENABLED'] = saved
+        shutil.rmtree(tmpdir)
@@ -5,17 +5,31 @@
     :copyright: © 2018 Grey Li
     :license: MIT, see LICENSE for more details.
 """
+import http.client
+import io
+import logging
 import os
-import uuid
-
-from flask import Flask, render_template, flash, redirect, url_for, request, send_from_directory, session
+import shutil
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import click
+from flask import Flask, render_template, flash, redirect, url_for, request, send_file, session, abort, jsonify
 from flask_ckeditor import CKEditor, upload_success, upload_fail
 from flask_dropzone import Dropzone
 from flask_wtf.csrf import validate_csrf
+from werkzeug.datastructures import FileStorage
+from werkzeug.serving import WSGIRequestHandler, make_server, run_simple
 from wtforms import ValidationError
 
 from forms import LoginForm, FortyTwoForm, NewPostForm, UploadForm, MultiUploadForm, SigninForm, \
     RegisterForm, SigninForm2, RegisterForm2, RichTextForm
+from derivatives import VARIANT_RE, Derivatives
+from serving import FileSender, SendfileRequestHandler
+from sessions import ServerSessionInterface, SQLiteSessionStore
+from storage import HASH_RE, NAME_RE, ChunkedUploads, ContentStore, UploadError
 
 app = Flask(__name__)
 app.secret_key = os.getenv('SECRET_KEY', 'secret string')
@@ -29,6 +43,32 @@ if not os.path.exists(app.config['UPLOAD_PATH']):
     os.makedirs(app.config['UPLOAD_PATH'])
 
 app.config['ALLOWED_EXTENSIONS'] = ['png', 'jpg', 'jpeg', 'gif']
+# threads writing the files of one upload request at the same time
+app.config['UPLOAD_WORKERS'] = 4
+
+# uploads are stored by content, the same image uploaded twice is on disk once
+store = ContentStore(app.config['UPLOAD_PATH'])
+upload_executor = ThreadPoolExecutor(max_workers=app.config['UPLOAD_WORKERS'])
+
+# smaller and WebP versions of uploaded images for the gallery, made by a
+# pool of processes after the upload (needs Pillow, else only originals)
+app.config['DERIVATIVE_WIDTHS'] = (200, 400, 800)
+app.config['DERIVATIVE_WORKERS'] = None  # one per CPU
+derivatives = Derivatives(os.path.join(app.config['UPLOAD_PATH'], 'derived'),
+                          widths=app.config['DERIVATIVE_WIDTHS'], workers=app.config['DERIVATIVE_WORKERS'])
+
+# keep sessions on the server, the filenames of 30 uploaded files don't fit
+# well in a cookie; the cookie only carries the session id
+app.config['SESSION_DB'] = os.getenv('SESSION_DB', os.path.join(app.root_path, 'sessions.db'))
+app.session_interface = ServerSessionInterface(SQLiteSessionStore(app.config['SESSION_DB']))
+
+# uploads are best sent by the front server: set to 'X-Sendfile' (Apache,
+# lighttpd) or to 'X-Accel-Redirect' (nginx, with an internal location at
+# UPLOAD_ACCEL_PREFIX aliased to UPLOAD_PATH); else they are sent from here
+app.config['UPLOAD_SENDFILE_HEADER'] = os.getenv('UPLOAD_SENDFILE_HEADER')
+app.config['UPLOAD_ACCEL_PREFIX'] = '/_uploads/'
+file_sender = FileSender(app.config['UPLOAD_PATH'], header=app.config['UPLOAD_SENDFILE_HEADER'],
+                         accel_prefix=app.config['UPLOAD_ACCEL_PREFIX'])
 
 # Flask config
 # set request body's max length
@@ -40,8 +80,15 @@ app.config['CKEDITOR_FILE_UPLOADER'] = 'upload_for_ckeditor'
 
 # Flask-Dropzone config
 app.config['DROPZONE_ALLOWED_FILE_TYPE'] = 'image'
-app.config['DROPZONE_MAX_FILE_SIZE'] = 3
+app.config['DROPZONE_MAX_FILE_SIZE'] = 100  # Mb, sent in chunks
 app.config['DROPZONE_MAX_FILES'] = 30
+app.config['DROPZONE_CHUNK_SIZE'] = 1024 * 1024
+# partial uploads left alone this long are deleted
+app.config['DROPZONE_PARTIAL_TIMEOUT'] = 24 * 60 * 60
+
+# Dropzone sends files in chunks, written into place as they arrive
+chunked_uploads = ChunkedUploads(os.path.join(app.config['UPLOAD_PATH'], 'partial'),
+                                 max_size=app.config['DROPZONE_MAX_FILE_SIZE'] * 1024 * 1024)
 
 ckeditor = CKEditor(app)
 dropzone = Dropzone(app)
@@ -91,25 +138,97 @@ def custom_validator():
     return render_template('custom_validator.html', form=form)
 
 
-@app.route('/uploads/<path:filename>')
+def send_stored(path, ext, etag):
+    # a stored file's name is its hash, so its content never changes and
+    # browsers can keep it forever; its type is the one detected on upload,
+    # never taken from the URL
+    response = file_sender.send(path, IMAGE_MIMETYPES[ext], etag)
+    response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    return response
+
+
+@app.route('/uploads/<filename>')
 def get_file(filename):
-    return send_from_directory(app.config['UPLOAD_PATH'], filename)
+    # stored as <hash>.<detected type>, so another extension finds no file
+    match = NAME_RE.match(filename)
+    if match is None or match.group(2) not in app.config['ALLOWED_EXTENSIONS'] \
+            or match.group(2) not in IMAGE_MIMETYPES:
+        abort(404)
+    digest, ext = match.groups()
+    return send_stored(store.path(digest, ext), ext, digest)
+
+
+@app.route('/uploads/<digest>/<name>')
+def get_derivative(digest, name):
+    match = VARIANT_RE.match(name)
+    if HASH_RE.match(digest) is None or match is None:
+        abort(404)
+    return send_stored(derivatives.path(digest, name), match.group(2), '%s-%s' % (digest, name))
+
+
+def gallery_image(filename):
+    """What the gallery needs to show an uploaded image: the original, and
+    once they are made, ``srcset`` values for its smaller versions."""
+    digest, ext = filename.rsplit('.', 1)
+    image = dict(url=url_for('get_file', filename=filename))
+    manifest = derivatives.manifest(digest)
+    if manifest is not None and manifest['variants']['webp']:
+        original = '%s %dw' % (image['url'], manifest['width'])
+        for fmt, variants in manifest['variants'].items():
+            image[fmt] = ', '.join(['%s %dw' % (url_for('get_derivative', digest=digest, name=name), width)
+                                    for width, name in reversed(variants)] + [original])
+        image.update(srcset=image[ext], width=manifest['width'], height=manifest['height'])
+    return image
 
 
 @app.route('/uploaded-images')
 def show_images():
-    return render_template('uploaded.html')
-
-
-def allowed_file(filename):
-    return '.' in filename and \
-           filename.rsplit('.', 1)[1].lower() in app.config['ALLOWED_EXTENSIONS']
-
-
-def random_filename(filename):
-    ext = os.path.splitext(filename)[1]
-    new_filename = uuid.uuid4().hex + ext
-    return new_filename
+    images = [gallery_image(filename) for filename in session.get('filenames', [])]
+    return render_template('uploaded.html', images=images)
+
+
+# image types told by the first bytes of the file, whatever it is called
+IMAGE_SIGNATURES = [
+    (b'\x89PNG\r\n\x1a\n', 'png'),
+    (b'\xff\xd8\xff', 'jpg'),
+    (b'GIF87a', 'gif'),
+    (b'GIF89a', 'gif'),
+]
+
+# what uploads and their versions are served as
+IMAGE_MIMETYPES = {'png': 'image/png', 'jpg': 'image/jpeg', 'gif': 'image/gif', 'webp': 'image/webp'}
+
+
+def image_type(f):
+    """Return the extension for an uploaded image, None if the file is not
+    one of the allowed types."""
+    head = f.stream.read(16)
+    f.stream.seek(0)
+    for signature, ext in IMAGE_SIGNATURES:
+        if head.startswith(signature) and ext in app.config['ALLOWED_EXTENSIONS']:
+            return ext
+    return None
+
+
+def save_files(files, exts):
+    """Store uploaded files through the upload pool, return the names to
+    get them back with."""
+    started = time.time()
+    saved = store.save_many([f.stream for f in files], exts, upload_executor)
+    elapsed = time.time() - started
+    for f, s in zip(files, saved):
+        app.logger.info('Saved %s: %d bytes in %.3fs (%.1f MB/s)%s', f.filename, s.size, s.seconds,
+                        s.size / max(s.seconds, 1e-6) / 1e6, ', duplicate' if s.duplicate else '')
+    for s, ext in zip(saved, exts):
+        derivatives.queue(s.digest, store.path(s.digest, ext), ext)
+    size = sum(s.size for s in saved)
+    app.logger.info('Saved %d files: %d bytes in %.3fs (%.1f MB/s)', len(saved), size, elapsed,
+                    size / max(elapsed, 1e-6) / 1e6)
+    return ['%s.%s' % (s.digest, ext) for s, ext in zip(saved, exts)]
+
+
+def save_file(f, ext):
+    return save_files([f], [ext])[0]
 
 
 @app.route('/upload', methods=['GET', 'POST'])
@@ -117,8 +236,11 @@ def upload():
     form = UploadForm()
     if form.validate_on_submit():
         f = form.photo.data
-        filename = random_filename(f.filename)
-        f.save(os.path.join(app.config['UPLOAD_PATH'], filename))
+        ext = image_type(f)
+        if ext is None:
+            flash('Invalid file type.')
+            return redirect(url_for('upload'))
+        filename = save_file(f, ext)
         flash('Upload success.')
         session['filenames'] = [filename]
         return redirect(url_for('show_images'))
@@ -130,8 +252,6 @@ def multi_upload():
     form = MultiUploadForm()
 
     if request.method == 'POST':
-        filenames = []
-
         # check csrf token
         try:
             validate_csrf(form.csrf_token.data)
@@ -144,46 +264,90 @@ def multi_upload():
             flash('This field is required.')
             return redirect(url_for('multi_upload'))
 
-        for f in request.files.getlist('photo'):
+        files = request.files.getlist('photo')
+        exts = []
+        for f in files:
             # if user does not select file, browser also
             # submit a empty part without filename
             # if f.filename == '':
             #     flash('No selected file.')
             #    return redirect(url_for('multi_upload'))
-            # check the file extension
-            if f and allowed_file(f.filename):
-                filename = random_filename(f.filename)
-                f.save(os.path.join(
-                    app.config['UPLOAD_PATH'], filename
-                ))
-                filenames.append(filename)
-            else:
+            # check the file type, before saving any of them
+            ext = image_type(f) if f else None
+            if ext is None:
                 flash('Invalid file type.')
                 return redirect(url_for('multi_upload'))
+            exts.append(ext)
+        filenames = save_files(files, exts)
         flash('Upload success.')
         session['filenames'] = filenames
         return redirect(url_for('show_images'))
     return render_template('upload.html', form=form)
 
 
+def save_chunk():
+    """Write one chunk of a Dropzone chunked upload."""
+    try:
+        index = int(request.form['dzchunkindex'])
+        chunk_size = int(request.form['dzchunksize'])
+        if int(request.form['dzchunkbyteoffset']) != index * chunk_size:
+            return 'Invalid chunk.', 400
+        chunked_uploads.write(request.form['dzuuid'], index, int(request.form['dztotalchunkcount']),
+                              int(request.form['dztotalfilesize']), chunk_size, request.files['file'].stream)
+    except UploadError as e:
+        return str(e), 400
+    except (KeyError, ValueError):  # missing or non-numeric fields
+        return 'Invalid chunk.', 400
+    return '', 204
+
+
 @app.route('/dropzone-upload', methods=['GET', 'POST'])
 def dropzone_upload():
     if request.method == 'POST':
+        if 'dzuuid' in request.form:
+            return save_chunk()
         # check if the post request has the file part
         if 'file' not in request.files:
             return 'This field is required.', 400
         f = request.files.get('file')
-
-        if f and allowed_file(f.filename):
-            filename = random_filename(f.filename)
-            f.save(os.path.join(
-                app.config['UPLOAD_PATH'], filename
-            ))
-        else:
+        ext = image_type(f) if f else None
+        if ext is None:
             return 'Invalid file type.', 400
+        save_file(f, ext)
     return render_template('dropzone.html')
 
 
+# which chunks of an upload the server has, a client picking up an
+# interrupted upload only sends the others
+@app.route('/dropzone-upload/<upload_id>')
+def dropzone_status(upload_id):
+    try:
+        received = chunked_uploads.received(upload_id)
+    except UploadError as e:
+        return str(e), 400
+    if received is None:
+        abort(404)
+    return jsonify(received=received[0], total=received[1])
+
+
+# Dropzone calls this once every chunk of a file is sent
+@app.route('/dropzone-upload/<upload_id>/finish', methods=['POST'])
+def dropzone_finish(upload_id):
+    try:
+        with chunked_uploads.open(upload_id) as stream:
+            f = FileStorage(stream, filename=request.form.get('filename', upload_id))
+            ext = image_type(f)
+            if ext is None:
+                chunked_uploads.discard(upload_id)
+                return 'Invalid file type.', 400
+            filename = save_file(f, ext)
+    except UploadError as e:
+        return str(e), 400
+    chunked_uploads.discard(upload_id)
+    chunked_uploads.expire(app.config['DROPZONE_PARTIAL_TIMEOUT'])
+    return jsonify(filename=filename, url=url_for('get_file', filename=filename))
+
+
 @app.route('/two-submits', methods=['GET', 'POST'])
 def two_submits():
     form = NewPostForm()
@@ -263,8 +427,98 @@ def integrate_ckeditor():
 @app.route('/upload-ck', methods=['POST'])
 def upload_for_ckeditor():
     f = request.files.get('upload')
-    if not allowed_file(f.filename):
+    ext = image_type(f)
+    if ext is None:
         return upload_fail('Image only!')
-    f.save(os.path.join(app.config['UPLOAD_PATH'], f.filename))
-    url = url_for('get_file', filename=f.filename)
+    url = url_for('get_file', filename=save_file(f, ext))
     return upload_success(url, f.filename)
+
+
+# upload pipeline benchmark
+@app.cli.command('bench-upload')
+@click.option('--files', 'count', default=30, help='Files per batch.')
+@click.option('--size', default=2 * 1024 * 1024, help='Bytes per file.')
+def bench_upload(count, size):
+    """Save a batch of distinct files one after another and through
+    thread pools of different sizes, into a temporary store."""
+    root = tempfile.mkdtemp()
+    try:
+        for workers in 0, 1, 2, 4, 8:
+            target = ContentStore(os.path.join(root, str(workers)))
+            streams = [io.BytesIO(os.urandom(size)) for _ in range(count)]
+            started = time.time()
+            if workers:
+                with ThreadPoolExecutor(max_workers=workers) as executor:
+                    saved = target.save_many(streams, ['bin'] * count, executor)
+            else:
+                # one by one, each synced on its own
+                saved = [target.save_many([stream], ['bin'])[0] for stream in streams]
+            elapsed = time.time() - started
+            slowest = max(s.seconds for s in saved)
+            click.echo('%-10s %6.1f MB/s aggregate, slowest file %.3fs (%.1f MB/s)' % (
+                '%d workers' % workers if workers else 'sequential', count * size / elapsed / 1e6,
+                slowest, size / slowest / 1e6))
+    finally:
+        shutil.rmtree(root)
+
+
+@app.cli.command('run-sendfile')
+@click.option('--host', default='127.0.0.1', help='The interface to bind to.')
+@click.option('--port', default=5000, help='The port to bind to.')
+def run_sendfile(host, port):
+    """Run the development server, sending uploads with os.sendfile."""
+    run_simple(host, port, app, threaded=True, request_handler=SendfileRequestHandler)
+
+
+@app.cli.command('bench-serve')
+@click.option('--size', default=256, help='Megabytes in the file.')
+@click.option('--rounds', default=3, help='Downloads per case, the fastest counts.')
+def bench_serve(size, rounds):
+    """Download a large file over a socket from a development server, sent
+    by send_file, by FileSender with and without os.sendfile, and a range
+    of it."""
+    root = tempfile.mkdtemp()
+    path = os.path.join(root, 'large')
+    with open(path, 'wb') as f:
+        for _ in range(size):
+            f.write(os.urandom(1024 * 1024))
+    sender = FileSender(root)
+    bench_app = Flask(__name__)
+    bench_app.add_url_rule('/send-file', 'send_file', lambda: send_file(path, conditional=True))
+    bench_app.add_url_rule('/file-sender', 'file_sender', lambda: sender.send(path))
+    half = size * 1024 * 1024 // 2
+    cases = [
+        ('send_file', WSGIRequestHandler, '/send-file', {}),
+        ('FileSender, read', WSGIRequestHandler, '/file-sender', {}),
+        ('FileSender, sendfile', SendfileRequestHandler, '/file-sender', {}),
+        ('range, read', WSGIRequestHandler, '/file-sender', {'Range': 'bytes=%d-' % half}),
+        ('range, sendfile', SendfileRequestHandler, '/file-sender', {'Range': 'bytes=%d-' % half}),
+    ]
+    buffer = memoryview(bytearray(1024 * 1024))
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)  # no request log
+    try:
+        for label, handler, url, headers in cases:
+            server = make_server('127.0.0.1', 0, bench_app, threaded=True, request_handler=handler)
+            thread = threading.Thread(target=server.serve_forever)
+            thread.start()
+            best = None
+            for _ in range(rounds):
+                connection = http.client.HTTPConnection('127.0.0.1', server.port)
+                started = time.time()
+                connection.request('GET', url, headers=headers)
+                response = connection.getresponse()
+                received = 0
+                while True:
+                    n = response.readinto(buffer)
+                    if not n:
+                        break
+                    received += n
+                elapsed = time.time() - started
+                connection.close()
+                best = elapsed if best is None else min(best, elapsed)
+            server.shutdown()
+            thread.join()
+            click.echo('%-22s %d %7.1f MB in %.3fs, %7.1f MB/s' % (
+                label, response.status, received / 1e6, best, received / best / 1e6))
+    finally:
+        shutil.rmtree(root)
@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+"""
+    :author: Grey Li (李辉)
+    :url: http://greyli.com
+    :copyright: © 2018 Grey Li
+    :license: MIT, see LICENSE for more details.
+"""
+import json
+import logging
+import multiprocessing
+import os
+import re
+import shutil
+import tempfile
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+
+logger = logging.getLogger(__name__)
+
+#: a derivative's name in the directory of its original, its width and format
+VARIANT_RE = re.compile(r'^(\d+)\.(webp|jpg|png)$')
+
+SAVE_OPTIONS = {
+    'webp': dict(format='WEBP', quality=80, method=4),
+    'jpg': dict(format='JPEG', quality=85, optimize=True, progressive=True),
+    'png': dict(format='PNG', optimize=True),
+}
+
+
+def make_derivatives(source, directory, widths, ext):
+    """Write the original at ``source`` scaled down to each of ``widths``,
+    as WebP and as ``ext``, into ``directory``, then the manifest listing
+    them.  Runs in a worker process."""
+    with Image.open(source) as im:
+        width, height = im.size
+        widths = sorted((w for w in widths if w < width), reverse=True)
+        if widths and im.format == 'JPEG':
+            # let the decoder do most of the scaling, a lot cheaper than
+            # decoding the full image to throw most of it away; a square
+            # box, the image may still be turned by its EXIF orientation
+            im.draft('RGB', (widths[0], widths[0]))
+        im = ImageOps.exif_transpose(im)
+        im = im.convert('RGBA' if 'A' in im.getbands() or 'transparency' in im.info else 'RGB')
+    if (im.width > im.height) != (width > height):  # turned by its EXIF orientation
+        width, height = height, width
+
+    tmp = tempfile.mkdtemp(dir=os.path.dirname(directory))
+    try:
+        variants = {'webp': [], ext: []}
+        for w in widths:
+            # each size from the one before, largest first
+            im = im.resize((w, max(1, round(im.height * w / im.width))), Image.LANCZOS, reducing_gap=3.0)
+            for fmt in variants:
+                name = '%d.%s' % (w, fmt)
+                (im.convert('RGB') if fmt == 'jpg' else im).save(os.path.join(tmp, name), **SAVE_OPTIONS[fmt])
+                variants[fmt].append((w, name))
+        manifest = {'width': width, 'height': height, 'variants': variants}
+        # written last, a directory with a manifest is complete
+        with open(os.path.join(tmp, 'manifest.json'), 'w') as f:
+            json.dump(manifest, f)
+        try:
+            os.rename(tmp, directory)
+        except OSError:  # made by someone else in the meantime
+            shutil.rmtree(tmp)
+    except BaseException:
+        shutil.rmtree(tmp, ignore_errors=True)
+        raise
+    return manifest
+
+
+class Derivatives(object):
+    """Smaller and WebP versions of stored images, made in a pool of
+    processes since decoding and resizing images is CPU bound and would
+    hold the GIL in a thread.
+
+    The versions of an image are in a directory named after its hash, with
+    a ``manifest.json`` describing them.  The directory is built elsewhere
+    and renamed into place, so it is either complete or absent.  Without
+    Pillow nothing is made and :meth:`manifest` is always None.
+
+    :param root: the directory to keep derivatives in.
+    :param widths: the widths to scale images down to.
+    :param workers: how many worker processes.
+    """
+
+    def __init__(self, root, widths=(200, 400, 800), workers=None):
+        self.root = root
+        self.widths = widths
+        self.workers = workers
+        self._executor = None
+        self._pending = set()
+        self._manifests = {}
+        self._lock = threading.Lock()
+        if not os.path.exists(root):
+            os.makedirs(root)
+
+    @property
+    def enabled(self):
+        return Image is not None
+
+    def path(self, digest, *names):
+        return os.path.join(self.root, digest[:2], digest[2:4], digest, *names)
+
+    def _get_executor(self):
+        # started on first use; spawned, not forked, a threaded server may
+        # hold locks at the time of the fork
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context('spawn'))
+        return self._executor
+
+    def queue(self, digest, source, ext):
+        """Have the versions of an image made in the background, unless
+        they exist or are being made."""
+        if not self.enabled or ext == 'gif':  # scaling would drop the animation
+            return
+        directory = self.path(digest)
+        with self._lock:
+            if digest in self._pending or os.path.exists(directory):
+                return
+            os.makedirs(os.path.dirname(directory), exist_ok=True)
+            try:
+                future = self._get_executor().submit(make_derivatives, source, directory, self.widths, ext)
+            except RuntimeError as e:  # BrokenProcessPool is one
+                # a worker died, e.g. out of memory: the pool takes no more
+                # work, the next image gets a new one; this one goes
+                # without versions, the upload itself is stored
+                if self._executor is not None:
+                    self._executor.shutdown(wait=False)
+                    self._executor = None
+                logger.error('Making the versions of %s failed: %r', digest, e)
+                return
+            self._pending.add(digest)
+        future.add_done_callback(lambda future: self._done(digest, future))
+
+    def _done(self, digest, future):
+        with self._lock:
+            self._pending.discard(digest)
+        if future.exception() is None:
+            self._manifests[digest] = future.result()
+        else:
+            logger.error('Making the versions of %s failed: %r', digest, future.exception())
+
+    def manifest(self, digest):
+        """Return the manifest of an image's versions, None until made."""
+        manifest = self._manifests.get(digest)
+        if manifest is None and digest not in self._pending:
+            try:
+                with open(self.path(digest, 'manifest.json')) as f:
+                    manifest = self._manifests[digest] = json.load(f)
+            except (IOError, OSError, ValueError):
+                return None
+        return manifest
@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+"""
+    :author: Grey Li (李辉)
+    :url: http://greyli.com
+    :copyright: © 2018 Grey Li
+    :license: MIT, see LICENSE for more details.
+"""
+import os
+import stat
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+
+from flask import Response, request
+from werkzeug.datastructures import ContentRange
+from werkzeug.exceptions import NotFound
+from werkzeug.http import is_resource_modified
+from werkzeug.serving import WSGIRequestHandler
+
+#: environ key under which :class:`SendfileRequestHandler` passes the socket
+SOCKET_KEY = 'serving.socket'
+
+
+class StatCache(object):
+    """``os.stat`` results kept for ``timeout`` seconds, so serving a file
+    doesn't stat it on every request.  Missing files are not remembered,
+    a file is found as soon as it is there.
+
+    :param timeout: how long a result is used.
+    :param max_size: how many results to keep.
+    """
+
+    def __init__(self, timeout=10, max_size=10000):
+        self.timeout = timeout
+        self.max_size = max_size
+        self._stats = OrderedDict()  # path -> (checked at, stat result)
+        self._lock = threading.Lock()
+
+    def get(self, path):
+        """Return the stat result of a regular file, None if there is none."""
+        now = time.time()
+        with self._lock:
+            entry = self._stats.get(path)
+            if entry is not None and entry[0] + self.timeout > now:
+                self._stats.move_to_end(path)
+                return entry[1]
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        if not stat.S_ISREG(st.st_mode):
+            return None
+        with self._lock:
+            self._stats[path] = (now, st)
+            self._stats.move_to_end(path)
+            while len(self._stats) > self.max_size:
+                self._stats.popitem(last=False)
+        return st
+
+
+def file_range(path, start, length, sock=None, chunk_size=256 * 1024):
+    """Yield ``length`` bytes of a file from ``start``.  Given the client's
+    socket, the kernel copies them straight from the file to it with
+    ``os.sendfile`` instead, and nothing goes through Python."""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        end = start + length
+        if sock is not None:
+            yield b''  # has the server send the status line and headers
+            while start < end:
+                sent = os.sendfile(sock.fileno(), fd, start, min(end - start, 1 << 30))
+                if not sent:
+                    break
+                start += sent
+            return
+        while start < end:
+            data = os.pread(fd, min(chunk_size, end - start), start)
+            if not data:
+                break
+            start += len(data)
+            yield data
+    finally:
+        os.close(fd)
+
+
+class SendfileRequestHandler(WSGIRequestHandler):
+    """Request handler for the development server that lets
+    :class:`FileSender` write files to the socket with ``os.sendfile``.
+
+    Only for apps that don't change response bodies after the view, e.g.
+    by compressing them, since those bytes never pass through the app.
+    Not used with TLS, which the kernel can't do for us.
+    """
+
+    def make_environ(self):
+        environ = super(SendfileRequestHandler, self).make_environ()
+        if self.server.ssl_context is None:
+            environ[SOCKET_KEY] = self.connection
+        return environ
+
+
+class FileSender(object):
+    """Serves files with strong validators, conditional requests and
+    single byte ranges (``Range``, ``If-Range``).  The type is the one
+    given by the caller, which should not take it from the URL.
+
+    The bytes go out, from the cheapest way available:
+
+    - not through the app at all, when ``header`` is ``'X-Sendfile'``
+      (Apache, lighttpd) or ``'X-Accel-Redirect'`` (nginx, with an
+      internal location at ``accel_prefix`` for ``root``); the front
+      server then handles ranges too;
+    - with ``os.sendfile`` under :class:`SendfileRequestHandler`;
+    - through the server's ``wsgi.file_wrapper`` for whole files, which
+      e.g. gunicorn sends with ``os.sendfile`` as well;
+    - read in chunks otherwise.
+
+    :param root: the directory files are served from.
+    :param header: ``'X-Sendfile'``, ``'X-Accel-Redirect'`` or None.
+    :param accel_prefix: the nginx location of ``root``.
+    :param stats: a :class:`StatCache`.
+    """
+
+    def __init__(self, root, header=None, accel_prefix='/_uploads/', stats=None, chunk_size=256 * 1024):
+        if header not in (None, 'X-Sendfile', 'X-Accel-Redirect'):
+            raise ValueError('Unsupported header %r.' % header)
+        self.root = os.path.abspath(root)
+        self.header = header
+        self.accel_prefix = accel_prefix
+        self.stats = stats or StatCache()
+        self.chunk_size = chunk_size
+
+    def _range_allowed(self, etag, last_modified):
+        # If-Range: the range only applies to the version the client has
+        if_range = request.if_range
+        if if_range.etag is not None:
+            return if_range.etag == etag
+        if if_range.date is not None:
+            return last_modified <= if_range.date
+        return True
+
+    def send(self, path, mimetype=None, etag=None):
+        """Return a response for the file at ``path``, with ``etag`` as its
+        ETag or one made from its inode, size and modification time."""
+        st = self.stats.get(path)
+        if st is None:
+            raise NotFound()
+        if etag is None:
+            etag = '%x-%x-%x' % (st.st_ino, st.st_size, st.st_mtime_ns)
+        last_modified = datetime.utcfromtimestamp(int(st.st_mtime))
+        response = Response(mimetype=mimetype or 'application/octet-stream', direct_passthrough=True)
+        # browsers must not guess another type, e.g. HTML, from the content
+        response.headers['X-Content-Type-Options'] = 'nosniff'
+        response.set_etag(etag)
+        response.last_modified = last_modified
+        if not is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+            response.status_code = 304
+            return response
+
+        if self.header is not None:
+            if self.header == 'X-Sendfile':
+                response.headers['X-Sendfile'] = os.path.abspath(path)
+            else:
+                relative = os.path.relpath(os.path.abspath(path), self.root).replace(os.sep, '/')
+                response.headers['X-Accel-Redirect'] = self.accel_prefix + relative
+            # the front server sends the body, and the length with it
+            response.content_length = st.st_size
+            return response
+
+        response.accept_ranges = 'bytes'
+        start, length = 0, st.st_size
+        if request.range is not None and request.range.units == 'bytes' and self._range_allowed(etag, last_modified):
+            byte_range = request.range.range_for_length(st.st_size)
+            if byte_range is not None:
+                start, stop = byte_range
+                length = stop - start
+                response.status_code = 206
+                response.content_range = ContentRange('bytes', start, stop, st.st_size)
+            elif len(request.range.ranges) == 1:
+                response.status_code = 416
+                response.headers['Content-Range'] = 'bytes */%d' % st.st_size
+                response.content_length = 0
+                return response
+            # several ranges: send the whole file, which is allowed
+
+        response.content_length = length
+        sock = request.environ.get(SOCKET_KEY)
+        if sock is None and length == st.st_size and 'wsgi.file_wrapper' in request.environ:
+            response.response = request.environ['wsgi.file_wrapper'](open(path, 'rb'), self.chunk_size)
+        else:
+            response.response = file_range(path, start, length, sock, self.chunk_size)
+        return response
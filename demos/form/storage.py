@@ -0,0 +1,281 @@
+# -*- coding: utf-8 -*-
+"""
+    :author: Grey Li (李辉)
+    :url: http://greyli.com
+    :copyright: © 2018 Grey Li
+    :license: MIT, see LICENSE for more details.
+"""
+import hashlib
+import os
+import re
+import sqlite3
+import tempfile
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import Future
+
+#: a stored file's hash
+HASH_RE = re.compile(r'^[0-9a-f]{64}$')
+
+#: a stored file's name, its hash and the extension of its detected type
+NAME_RE = re.compile(r'^([0-9a-f]{64})\.([a-z0-9]+)$')
+
+#: what :meth:`ContentStore.save_many` reports for each file: its hash,
+#: size, the seconds spent hashing and writing it, and whether it was a
+#: duplicate of a stored file
+Saved = namedtuple('Saved', ['digest', 'size', 'seconds', 'duplicate'])
+
+
+def _fsync(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _run_now(f, *args):
+    """Run f like ``executor.submit`` would, without an executor."""
+    future = Future()
+    try:
+        future.set_result(f(*args))
+    except Exception as e:
+        future.set_exception(e)
+    return future
+
+
+class ContentStore(object):
+    """Uploads stored under the SHA-256 of their content, in
+    ``root/ab/cd/<hash>.<ext>``, so each distinct file is on disk once.
+
+    The extension is the file's type as detected when it was uploaded, not
+    the one it came with; being part of the name on disk, a file can only
+    be found, and so served, as that type.  The same content always gets
+    the same type.  An index keeps how many uploads refer to each file.
+
+    :param root: the directory to store files in.
+    :param chunk_size: bytes read from an upload at a time.
+    """
+
+    def __init__(self, root, chunk_size=64 * 1024):
+        self.root = root
+        self.chunk_size = chunk_size
+        self.tmp_path = os.path.join(root, 'tmp')
+        if not os.path.exists(self.tmp_path):
+            os.makedirs(self.tmp_path)
+        self._local = threading.local()
+        self._execute('CREATE TABLE IF NOT EXISTS files '
+                      '(hash TEXT PRIMARY KEY, size INTEGER NOT NULL, refs INTEGER NOT NULL)')
+
+    def _execute(self, sql, parameters=()):
+        # SQLite connections can't be shared between threads
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = self._local.connection = sqlite3.connect(
+                os.path.join(self.root, 'index.db'), timeout=5, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+        return connection.execute(sql, parameters)
+
+    def path(self, digest, ext):
+        return os.path.join(self.root, digest[:2], digest[2:4], '%s.%s' % (digest, ext))
+
+    def _chunks(self, stream):
+        return iter(lambda: stream.read(self.chunk_size), b'')
+
+    def _add_ref(self, digest):
+        """Count one more upload of a stored file, False if it isn't stored."""
+        return self._execute('UPDATE files SET refs = refs + 1 WHERE hash = ?', (digest,)).rowcount == 1
+
+    def _spool(self, stream):
+        """Hash a file and copy it to a temporary file unless it's stored
+        already, return its :class:`Saved` and the temporary file."""
+        started = time.time()
+        if stream.seekable():
+            # hash it first, a duplicate is then never written at all
+            sha256 = hashlib.sha256()
+            size = 0
+            for chunk in self._chunks(stream):
+                sha256.update(chunk)
+                size += len(chunk)
+            digest = sha256.hexdigest()
+            if self._add_ref(digest):
+                return Saved(digest, size, time.time() - started, True), None
+            stream.seek(0)
+
+        # write it to a temporary file, hashing as it goes
+        sha256 = hashlib.sha256()
+        size = 0
+        fd, tmp = tempfile.mkstemp(dir=self.tmp_path)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in self._chunks(stream):
+                    sha256.update(chunk)
+                    f.write(chunk)
+                    size += len(chunk)
+        except BaseException:
+            os.remove(tmp)
+            raise
+        digest = sha256.hexdigest()
+        if self._add_ref(digest):
+            os.remove(tmp)
+            return Saved(digest, size, time.time() - started, True), None
+        return Saved(digest, size, time.time() - started, False), tmp
+
+    def save(self, stream, ext):
+        """Store the content of a file object of type ``ext``, return its
+        hash."""
+        return self.save_many([stream], [ext])[0].digest
+
+    def save_many(self, streams, exts, executor=None):
+        """Store several file objects of the types ``exts``, concurrently
+        when given an ``executor``, and return a :class:`Saved` for each.
+
+        The files are synced to disk as one batch once they are all
+        written, then moved into place, so a crash never leaves a partly
+        written file under a hash.
+        """
+        run = executor.submit if executor is not None else _run_now
+        futures = [run(self._spool, stream) for stream in streams]
+        spooled = [future.result() for future in futures if future.exception() is None]
+        errors = [future.exception() for future in futures if future.exception() is not None]
+        try:
+            if errors:
+                raise errors[0]
+            for future in [run(_fsync, tmp) for saved, tmp in spooled if tmp is not None]:
+                future.result()
+        except BaseException:
+            # nothing of the batch is stored: drop the temporary files and
+            # the counts already added for duplicates
+            for saved, tmp in spooled:
+                if tmp is None:
+                    self._execute('UPDATE files SET refs = refs - 1 WHERE hash = ?', (saved.digest,))
+                else:
+                    os.remove(tmp)
+            raise
+
+        directories = set()
+        for (saved, tmp), ext in zip(spooled, exts):
+            if tmp is None:
+                continue
+            path = self.path(saved.digest, ext)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # same content, so it doesn't matter whose file ends up there
+            os.replace(tmp, path)
+            directories.add(os.path.dirname(path))
+            self._execute('INSERT INTO files (hash, size, refs) VALUES (?, ?, 1) '
+                          'ON CONFLICT (hash) DO UPDATE SET refs = refs + 1', (saved.digest, saved.size))
+        for directory in directories:
+            _fsync(directory)  # makes the renames durable
+        return [saved for saved, tmp in spooled]
+
+
+class UploadError(ValueError):
+    """A chunk or a chunked upload that doesn't add up."""
+
+
+class ChunkedUploads(object):
+    """Files uploaded in chunks, as Dropzone does with ``chunking: true``.
+
+    The first chunk to arrive creates a file of the full size, and every
+    chunk is written straight at its offset into it, so chunks can arrive
+    in any order and in parallel.  A map with one byte per chunk tells
+    which ones have been received, so an interrupted upload only needs
+    the missing ones.  :meth:`open` gives back the file once it is
+    complete.
+
+    :param root: directory for the partial files.
+    :param max_size: largest file accepted, in bytes.
+    :param chunk_size: bytes read from a chunk at a time.
+    """
+
+    #: Dropzone's ``dzuuid``, also the partial file's name
+    ID_RE = re.compile(r'^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}$')
+
+    def __init__(self, root, max_size, chunk_size=64 * 1024):
+        self.root = root
+        self.max_size = max_size
+        self.chunk_size = chunk_size
+        if not os.path.exists(root):
+            os.makedirs(root)
+
+    def _path(self, upload_id, suffix):
+        if not self.ID_RE.match(upload_id):
+            raise UploadError('Invalid upload id.')
+        return os.path.join(self.root, upload_id + suffix)
+
+    def write(self, upload_id, index, count, size, chunk_size, stream):
+        """Write chunk ``index`` of ``count`` of a ``size`` bytes file cut
+        in ``chunk_size`` bytes chunks."""
+        if not 0 < size <= self.max_size or chunk_size <= 0 or count != -(-size // chunk_size) \
+                or not 0 <= index < count:
+            raise UploadError('Invalid chunk.')
+        offset = index * chunk_size
+        expected = min(chunk_size, size - offset)
+        fd = os.open(self._path(upload_id, '.part'), os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if os.fstat(fd).st_size == 0:
+                # reserve the space up front, the file doesn't fragment
+                # and a full disk fails on the first chunk
+                if hasattr(os, 'posix_fallocate'):
+                    os.posix_fallocate(fd, 0, size)
+                else:
+                    os.ftruncate(fd, size)
+            elif os.fstat(fd).st_size != size:
+                raise UploadError('Chunk of another file.')
+            written = 0
+            for data in iter(lambda: stream.read(self.chunk_size), b''):
+                if written + len(data) > expected:
+                    raise UploadError('Chunk too large.')
+                os.pwrite(fd, data, offset + written)
+                written += len(data)
+            if written != expected:
+                raise UploadError('Incomplete chunk.')
+        finally:
+            os.close(fd)
+        fd = os.open(self._path(upload_id, '.map'), os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if os.fstat(fd).st_size == 0:
+                os.ftruncate(fd, count)
+            os.pwrite(fd, b'\x01', index)
+        finally:
+            os.close(fd)
+
+    def received(self, upload_id):
+        """Return the indexes of the chunks received and how many there
+        are in all, or None for an unknown upload."""
+        try:
+            with open(self._path(upload_id, '.map'), 'rb') as f:
+                chunks = f.read()
+        except (IOError, OSError):
+            return None
+        return [index for index, flag in enumerate(chunks) if flag], len(chunks)
+
+    def open(self, upload_id):
+        """Open a complete upload for reading, it is left in place so it
+        can be checked before :meth:`discard`."""
+        received = self.received(upload_id)
+        if received is None:
+            raise UploadError('Unknown upload.')
+        indexes, count = received
+        if len(indexes) != count:
+            raise UploadError('Missing %d of %d chunks.' % (count - len(indexes), count))
+        return open(self._path(upload_id, '.part'), 'rb')
+
+    def discard(self, upload_id):
+        for suffix in '.part', '.map':
+            try:
+                os.remove(self._path(upload_id, suffix))
+            except OSError:
+                pass
+
+    def expire(self, max_age):
+        """Delete partial uploads untouched for ``max_age`` seconds."""
+        limit = time.time() - max_age
+        for name in os.listdir(self.root):
+            path = os.path.join(self.root, name)
+            try:
+                if os.path.getmtime(path) < limit:
+                    os.remove(path)
+            except OSError:  # discarded or expired by someone else meanwhile
+                continue
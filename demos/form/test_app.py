@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+"""
+    :author: Grey Li (李辉)
+    :url: http://greyli.com
+    :copyright: © 2018 Grey Li
+    :license: MIT, see LICENSE for more details.
+"""
+import io
+import os
+import shutil
+import tempfile
+import unittest
+
+tmp = tempfile.mkdtemp()
+os.environ['SESSION_DB'] = os.path.join(tmp, 'sessions.db')
+
+import app as form_app  # noqa: E402
+from derivatives import Derivatives  # noqa: E402
+from storage import ContentStore  # noqa: E402
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+
+def tearDownModule():
+    shutil.rmtree(tmp, ignore_errors=True)
+
+
+@unittest.skipIf(Image is None, 'no PIL module found')
+class UploadTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp(dir=tmp)
+        self.store, self.derivatives = form_app.store, form_app.derivatives
+        form_app.store = ContentStore(self.root)
+        form_app.derivatives = Derivatives(os.path.join(self.root, 'derived'), workers=1)
+        self.csrf_enabled = form_app.app.config.get('WTF_CSRF_ENABLED', True)
+        form_app.app.config['WTF_CSRF_ENABLED'] = False
+        self.client = form_app.app.test_client()
+
+    def tearDown(self):
+        executor = form_app.derivatives._executor
+        if executor is not None:
+            executor.shutdown()
+        form_app.store, form_app.derivatives = self.store, self.derivatives
+        form_app.app.config['WTF_CSRF_ENABLED'] = self.csrf_enabled
+
+    def upload(self, color):
+        image = io.BytesIO()
+        Image.new('RGB', (300, 200), color).save(image, 'PNG')
+        image.seek(0)
+        return self.client.post('/upload', data={'photo': (image, 'photo.png')})
+
+    def test_upload_with_broken_derivative_pool(self):
+        # a worker dying, as when killed for using too much memory
+        future = form_app.derivatives._get_executor().submit(os._exit, 1)
+        self.assertRaises(Exception, future.result)
+
+        response = self.upload('red')
+        self.assertEqual(response.status_code, 302)
+        self.assertTrue(response.location.endswith('/uploaded-images'))
+        self.assertEqual(form_app.derivatives._pending, set())
+
+        # the next upload gets a new pool, and its versions
+        response = self.upload('blue')
+        self.assertEqual(response.status_code, 302)
+        digest = form_app.store._execute('SELECT hash FROM files ORDER BY rowid DESC').fetchone()[0]
+        form_app.derivatives._executor.shutdown()  # waits for the versions
+        self.assertIsNotNone(form_app.derivatives.manifest(digest))
+        self.assertEqual(len(form_app.store._execute('SELECT hash FROM files').fetchall()), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -5,20 +5,39 @@
     :copyright: © 2018 Grey Li
     :license: MIT, see LICENSE for more details.
 """
+import gzip
+import hashlib
 import os
+import time
+import zlib
 # 由于python2和python3中urlparse, urljoin所在的包不同，所以这里做了个兼容性处理
 try:
     from urlparse import urlparse, urljoin
 except ImportError:
     from urllib.parse import urlparse, urljoin
 
+import click
 from jinja2 import escape
 from jinja2.utils import generate_lorem_ipsum
+from werkzeug.datastructures import MIMEAccept
+from werkzeug.http import parse_accept_header
+from werkzeug.test import EnvironBuilder
 from flask import Flask, make_response, request, redirect, url_for, abort, session, jsonify
 
+try:
+    import brotli
+except ImportError:  # gzip only
+    brotli = None
+
+from sessions import ServerSessionInterface, SQLiteSessionStore
+
 app = Flask(__name__)
 app.secret_key = os.getenv('SECRET_KEY', 'secret string')
 
+# server-side sessions, the cookie only carries an opaque session id
+app.config['SESSION_DB'] = os.getenv('SESSION_DB', os.path.join(app.root_path, 'sessions.db'))
+app.session_interface = ServerSessionInterface(SQLiteSessionStore(app.config['SESSION_DB']))
+
 
 # get name value from query string and cookie
 @app.route('/')
@@ -73,10 +92,7 @@ def not_found():
 
 # return response with different formats
 # 展示4种MIME类型的响应数据
-@app.route('/note', defaults={'content_type': 'text'})
-@app.route('/note/<content_type>')
-def note(content_type):
-    content_type = content_type.lower()
+def render_note(content_type):
     if content_type == 'text':
         body = '''Note
 to: Peter
@@ -129,6 +145,181 @@ body: Don't forget the party!
     return response
 
 
+class Representations(object):
+    """Every representation of one resource, serialized and gzipped once,
+    then picked per request from the Accept and Accept-Encoding headers.
+
+    Negotiation results are remembered per header value, so serving a
+    request is a dictionary lookup plus writing the prepared bytes.
+    """
+
+    #: how many distinct header values to remember
+    max_negotiations = 256
+
+    def __init__(self):
+        self.variants = {}  # (mimetype, encoding) -> (body, headers)
+        self.mimetypes = []  # in order of preference
+        self._mimetype_for = {}
+        self._encoding_for = {}
+
+    def add(self, response):
+        """Register the representation in a prepared response."""
+        body = response.get_data()
+        mimetype = response.mimetype
+        for encoding, data in (('identity', body), ('gzip', gzip.compress(body, 9, mtime=0))):
+            if len(data) >= len(body) and encoding != 'identity':
+                # not worth it for tiny bodies
+                self.variants[mimetype, encoding] = self.variants[mimetype, 'identity']
+                continue
+            headers = [('Content-Type', response.content_type),
+                       ('ETag', '"%s"' % hashlib.md5(data).hexdigest())]
+            if encoding != 'identity':
+                headers.append(('Content-Encoding', encoding))
+            # one header list for each Vary, so nothing is built per request
+            self.variants[mimetype, encoding] = (
+                data, headers + [('Vary', 'Accept, Accept-Encoding')], headers + [('Vary', 'Accept-Encoding')])
+        self.mimetypes.append(mimetype)
+
+    def _remember(self, memo, value, result):
+        if len(memo) >= self.max_negotiations:
+            memo.clear()
+        memo[value] = result
+        return result
+
+    def negotiate(self, accept):
+        """Return the best mimetype for an Accept header, or None when
+        none is acceptable."""
+        try:
+            return self._mimetype_for[accept]
+        except KeyError:
+            # no Accept header means anything goes
+            mimetype = parse_accept_header(accept, MIMEAccept).best_match(self.mimetypes) \
+                if accept else self.mimetypes[0]
+            return self._remember(self._mimetype_for, accept, mimetype)
+
+    def encoding(self, accept_encoding):
+        try:
+            return self._encoding_for[accept_encoding]
+        except KeyError:
+            encoding = 'gzip' if parse_accept_header(accept_encoding)['gzip'] else 'identity'
+            return self._remember(self._encoding_for, accept_encoding, encoding)
+
+    def response(self, mimetype, negotiated=True):
+        body, negotiated_headers, headers = \
+            self.variants[mimetype, self.encoding(request.environ.get('HTTP_ACCEPT_ENCODING', ''))]
+        return app.response_class(body, headers=negotiated_headers if negotiated else headers)
+
+
+NOTE_TYPES = {'text': 'text/plain', 'html': 'text/html', 'xml': 'application/xml', 'json': 'application/json'}
+
+# built once at startup, text first since it's what */* gets
+note_representations = Representations()
+with app.test_request_context():
+    for content_type in 'text', 'html', 'xml', 'json':
+        note_representations.add(render_note(content_type))
+
+
+# /note picks the format from the Accept header, /note/<content_type> asks
+# for one explicitly
+@app.route('/note', defaults={'content_type': None})
+@app.route('/note/<content_type>')
+def note(content_type):
+    if content_type is None:
+        mimetype = note_representations.negotiate(request.environ.get('HTTP_ACCEPT', ''))
+        if mimetype is None:
+            abort(406)
+    else:
+        mimetype = NOTE_TYPES.get(content_type.lower())
+        if mimetype is None:
+            abort(400)
+    return note_representations.response(mimetype, negotiated=content_type is None)
+
+
+# conditional GET: tag full responses with a strong ETag computed from the
+# body, a client sending it back in If-None-Match gets an empty 304
+@app.after_request
+def add_etag(response):
+    if request.method in ('GET', 'HEAD') and response.status_code == 200 and not response.is_streamed:
+        if 'ETag' not in response.headers:
+            response.add_etag()
+        response.make_conditional(request)
+    return response
+
+
+# compression: bodies of the text types below and above the threshold are
+# sent with brotli (when installed) or gzip, whatever the client accepts;
+# streamed bodies are compressed chunk by chunk as they go out. Registered
+# after add_etag() so it runs first and the ETag is that of what's sent.
+app.config['COMPRESS_MIN_SIZE'] = 500
+app.config['COMPRESS_MIMETYPES'] = {'text/html', 'text/plain', 'text/css', 'text/xml', 'application/json',
+                                    'application/xml', 'application/javascript'}
+app.config['COMPRESS_LEVELS'] = {'br': 4, 'gzip': 6}
+
+
+def choose_encoding(accept_encoding):
+    accepted = parse_accept_header(accept_encoding)
+    if brotli is not None and accepted['br']:
+        return 'br'
+    if accepted['gzip']:
+        return 'gzip'
+    return None
+
+
+def make_compressor(encoding, level=None):
+    """Return a ``(compress, flush, finish)`` triple for incremental
+    compression, flush() ends a chunk so the client can decode it now."""
+    if level is None:
+        level = app.config['COMPRESS_LEVELS'][encoding]
+    if encoding == 'br':
+        compressor = brotli.Compressor(quality=level)
+        return compressor.process, compressor.flush, compressor.finish
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)  # gzip container
+    return compressor.compress, lambda: compressor.flush(zlib.Z_SYNC_FLUSH), compressor.flush
+
+
+def compress_data(data, encoding, level=None):
+    compress, flush, finish = make_compressor(encoding, level)
+    return compress(data) + finish()
+
+
+def compress_stream(chunks, encoding, charset):
+    compress, flush, finish = make_compressor(encoding)
+    try:
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode(charset)
+            data = compress(chunk) + flush()
+            if data:
+                yield data
+        yield finish()
+    finally:
+        if hasattr(chunks, 'close'):
+            chunks.close()
+
+
+@app.after_request
+def compress_response(response):
+    if response.mimetype not in app.config['COMPRESS_MIMETYPES'] or 'Content-Encoding' in response.headers \
+            or response.status_code < 200 or response.status_code in (204, 206, 304):
+        return response
+    # a sequence body may not have its Content-Length set yet
+    if not response.is_streamed and response.content_length is not None \
+            and response.content_length < app.config['COMPRESS_MIN_SIZE']:
+        return response
+    response.vary.add('Accept-Encoding')
+    encoding = choose_encoding(request.environ.get('HTTP_ACCEPT_ENCODING', ''))
+    if encoding is None:
+        return response
+    if response.is_streamed:
+        response.response = compress_stream(response.response, encoding, response.charset)
+        response.headers.pop('Content-Length', None)
+    else:
+        response.set_data(compress_data(response.get_data(), encoding))
+        response.headers.pop('ETag', None)  # it was the uncompressed body's
+    response.headers['Content-Encoding'] = encoding
+    return response
+
+
 # set cookie
 @app.route('/set/<name>')
 def set_cookie(name):
@@ -161,32 +352,80 @@ def logout():
 
 
 # AJAX
+# the post is a feed of paragraphs, streamed as they are generated; /more
+# takes the cursor of the next paragraph and tells the next one in the
+# X-Next-Cursor header, which is missing at the end of the post
+app.config['POST_LENGTH'] = 1000
+app.config['POST_CHUNK_SIZE'] = 3
+app.config['POST_MAX_CHUNK_SIZE'] = 100
+
+
+def get_chunk_size():
+    chunk = request.args.get('chunk', app.config['POST_CHUNK_SIZE'], type=int)
+    return max(1, min(chunk, app.config['POST_MAX_CHUNK_SIZE']))
+
+
+def generate_paragraphs(cursor, chunk):
+    for index in range(cursor, min(cursor + chunk, app.config['POST_LENGTH'])):
+        yield '<p data-index="%d">%s</p>\n' % (index, generate_lorem_ipsum(n=1, html=False))
+
+
+def next_cursor(cursor, chunk):
+    if cursor + chunk < app.config['POST_LENGTH']:
+        return cursor + chunk
+    return None
+
+
 @app.route('/post')
 def show_post():
-    post_body = generate_lorem_ipsum(n=3)
-    return '''
-<h1>A very long post</h1>
-<div class="body">%s</div>
-<button id="load">Load More</button>
+    chunk = get_chunk_size()
+
+    def generate():
+        yield '<h1>A very long post</h1>\n<div class="body">\n'
+        for paragraph in generate_paragraphs(0, chunk):
+            yield paragraph
+        cursor = next_cursor(0, chunk)
+        if cursor is None:  # the first chunk was the whole post
+            yield '</div>\n'
+            return
+        yield '''</div>
+<button id="load" data-cursor="%d">Load More</button>
 <script src="https://code.jquery.com/jquery-3.3.1.min.js"></script>
 <script type="text/javascript">
 $(function() {
     $('#load').click(function() {
+        var $button = $(this);
         $.ajax({
             url: '/more',
             type: 'get',
-            success: function(data){
+            data: {cursor: $button.data('cursor'), chunk: %d},
+            success: function(data, status, xhr){
                 $('.body').append(data);
+                var cursor = xhr.getResponseHeader('X-Next-Cursor');
+                if (cursor === null) {
+                    $button.remove();
+                } else {
+                    $button.data('cursor', cursor);
+                }
             }
         })
     })
 })
-</script>''' % post_body
+</script>''' % (cursor, chunk)
+
+    return app.response_class(generate(), mimetype='text/html')
 
 
 @app.route('/more')
 def load_post():
-    return generate_lorem_ipsum(n=1)
+    cursor = request.args.get('cursor', 0, type=int)
+    if cursor < 0:
+        abort(400)
+    chunk = get_chunk_size()
+    response = app.response_class(generate_paragraphs(cursor, chunk), mimetype='text/html')
+    if next_cursor(cursor, chunk) is not None:
+        response.headers['X-Next-Cursor'] = str(next_cursor(cursor, chunk))
+    return response
 
 
 # redirect to last page
@@ -230,3 +469,88 @@ def redirect_back(default='hello', **kwargs):
         if is_safe_url(target):
             return redirect(target)
     return redirect(url_for(default, **kwargs))  # 如果前面方法都定位失败，则定位到'hello'视图
+
+
+# compare the precomputed /note with building it on every request
+@app.cli.command('bench-note')
+@click.option('--requests', 'count', default=5000, help='Requests per case.')
+def bench_note(count):
+    """Measure req/s of /note against the same responses rebuilt by
+    render_note() for every request, calling the WSGI app directly."""
+    app.add_url_rule('/note-rebuilt/<content_type>', 'note_rebuilt', render_note)
+
+    def start_response(status, headers, exc_info=None):
+        pass
+
+    for content_type, mimetype in sorted(NOTE_TYPES.items()):
+        cases = [
+            ('rebuilt', '/note-rebuilt/%s' % content_type, {}),
+            ('precomputed', '/note/%s' % content_type, {}),
+            ('negotiated', '/note', {'Accept': mimetype}),
+            ('gzip', '/note', {'Accept': mimetype, 'Accept-Encoding': 'gzip'}),
+        ]
+        for label, path, headers in cases:
+            environ = EnvironBuilder(path, headers=headers).get_environ()
+            started = time.time()
+            for _ in range(count):
+                b''.join(app(environ.copy(), start_response))
+            rate = count / (time.time() - started)
+            # the view alone, without Flask's own per-request work
+            with app.request_context(environ.copy()) as ctx:
+                view = app.view_functions[ctx.request.url_rule.endpoint]
+                started = time.time()
+                for _ in range(count):
+                    view(**ctx.request.view_args)
+                click.echo('%-5s %-12s %8.0f req/s %8.1f us in the view' % (
+                    content_type, label, rate, (time.time() - started) / count * 1e6))
+
+
+# time to first byte of a long post, streamed or joined into one string
+@app.cli.command('bench-post')
+@click.option('--paragraphs', default=5000, help='Paragraphs in the post.')
+@click.option('--rounds', default=5, help='Requests per case.')
+def bench_post(paragraphs, rounds):
+    """Measure time to first byte and total time of /more for a very long
+    post, streamed and built as one string."""
+    app.config['POST_LENGTH'] = app.config['POST_MAX_CHUNK_SIZE'] = paragraphs
+    app.add_url_rule('/more-joined', 'more_joined', lambda: ''.join(generate_paragraphs(0, paragraphs)))
+
+    def start_response(status, headers, exc_info=None):
+        pass
+
+    for label, path in ('joined', '/more-joined'), ('streamed', '/more?chunk=%d' % paragraphs):
+        environ = EnvironBuilder(path).get_environ()
+        first = total = 0
+        for _ in range(rounds):
+            started = time.time()
+            app_iter = iter(app(environ.copy(), start_response))
+            next(app_iter)
+            first += time.time() - started
+            for data in app_iter:
+                pass
+            total += time.time() - started
+        click.echo('%-8s TTFB %8.2f ms  total %8.2f ms' % (label, first / rounds * 1e3, total / rounds * 1e3))
+
+
+# compression levels: CPU time against bytes saved
+@app.cli.command('bench-compress')
+@click.option('--rounds', default=20, help='Compressions per level.')
+def bench_compress(rounds):
+    """Compress a long post and the JSON note at each gzip and brotli
+    level, report the size and the time it takes."""
+    client = app.test_client(use_cookies=False)
+    bodies = [
+        ('post', client.get('/more?chunk=100').get_data()),
+        ('json', client.get('/note/json').get_data()),
+    ]
+    levels = [('gzip', level) for level in (1, 6, 9)]
+    if brotli is not None:
+        levels += [('br', level) for level in (1, 4, 9, 11)]
+    for name, body in bodies:
+        click.echo('%s: %d bytes' % (name, len(body)))
+        for encoding, level in levels:
+            started = time.time()
+            for _ in range(rounds):
+                data = compress_data(body, encoding, level)
+            click.echo('  %-4s %2d %7d bytes %5.1f%% %9.1f us' % (
+                encoding, level, len(data), 100.0 * len(data) / len(body), (time.time() - started) / rounds * 1e6))
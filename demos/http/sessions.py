@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+"""
+    :author: Grey Li (李辉)
+    :url: http://greyli.com
+    :copyright: © 2018 Grey Li
+    :license: MIT, see LICENSE for more details.
+"""
+import pickle
+import secrets
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from flask.sessions import SessionInterface, SessionMixin
+from werkzeug.datastructures import CallbackDict
+
+# every demo runs on its own, so the http and form demos each have a copy of
+# this module: keep demos/http/sessions.py and demos/form/sessions.py the same
+
+
+class ServerSession(CallbackDict, SessionMixin):
+    """Session data kept on the server, the cookie only holds :attr:`sid`."""
+
+    def __init__(self, initial=None, sid=None, new=False):
+        def on_update(self):
+            self.modified = True
+
+        super(ServerSession, self).__init__(initial, on_update)
+        self.sid = sid
+        self.new = new
+        self.modified = False
+
+
+class SQLiteSessionStore(object):
+    """Pickled sessions in a SQLite table, with an in-memory LRU of the
+    most recently used ones in front, so most requests don't touch the
+    database at all.
+
+    The LRU is per process; with several worker processes an entry may be
+    served from memory after another process changed it, for up to
+    ``memory_timeout`` seconds.
+
+    :param path: the database file.
+    :param memory_size: how many sessions to keep in memory.
+    :param memory_timeout: how long a session may be served from memory.
+    """
+
+    def __init__(self, path, memory_size=1000, memory_timeout=10):
+        self.path = path
+        self.memory_size = memory_size
+        self.memory_timeout = memory_timeout
+        self._memory = OrderedDict()  # sid -> (read at, expires, pickled data)
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._execute('CREATE TABLE IF NOT EXISTS sessions '
+                      '(sid TEXT PRIMARY KEY, data BLOB NOT NULL, expires REAL NOT NULL)')
+        self._execute('CREATE INDEX IF NOT EXISTS sessions_expires ON sessions (expires)')
+
+    def _execute(self, sql, parameters=()):
+        # SQLite connections can't be shared between threads
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = self._local.connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+        return connection.execute(sql, parameters)
+
+    def _remember(self, sid, expires, data):
+        with self._lock:
+            self._memory[sid] = (time.time(), expires, data)
+            self._memory.move_to_end(sid)
+            while len(self._memory) > self.memory_size:
+                self._memory.popitem(last=False)
+
+    def get(self, sid):
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(sid)
+            if entry is not None and entry[0] + self.memory_timeout > now:
+                self._memory.move_to_end(sid)
+                read_at, expires, data = entry
+                return pickle.loads(data) if expires > now else None
+        row = self._execute('SELECT data, expires FROM sessions WHERE sid = ?', (sid,)).fetchone()
+        if row is None or row[1] <= now:
+            return None
+        self._remember(sid, row[1], row[0])
+        return pickle.loads(row[0])
+
+    def set(self, sid, data, expires):
+        data = pickle.dumps(dict(data), pickle.HIGHEST_PROTOCOL)
+        self._execute('INSERT OR REPLACE INTO sessions (sid, data, expires) VALUES (?, ?, ?)', (sid, data, expires))
+        self._remember(sid, expires, data)
+
+    def delete(self, sid):
+        self._execute('DELETE FROM sessions WHERE sid = ?', (sid,))
+        with self._lock:
+            self._memory.pop(sid, None)
+
+    def expire(self):
+        """Delete every expired session in one statement, return how many."""
+        return self._execute('DELETE FROM sessions WHERE expires <= ?', (time.time(),)).rowcount
+
+
+class ServerSessionInterface(SessionInterface):
+    """Keeps sessions in a :class:`SQLiteSessionStore` and sends only an
+    opaque, random session id in the cookie.
+
+    A session is written back only when it was modified, a new one only
+    once something is put in it.  Sessions live for
+    ``PERMANENT_SESSION_LIFETIME`` after their last write, and expired
+    ones are deleted in one batch at most every ``expire_interval``
+    seconds.
+    """
+
+    session_class = ServerSession
+
+    def __init__(self, store, expire_interval=60):
+        self.store = store
+        self.expire_interval = expire_interval
+        self._next_expiry = 0
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(app.session_cookie_name)
+        if sid:
+            data = self.store.get(sid)
+            if data is not None:
+                return self.session_class(data, sid=sid)
+        return self.session_class(sid=secrets.token_urlsafe(32), new=True)
+
+    def save_session(self, app, session, response):
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        if not session:
+            if session.modified:  # emptied, e.g. on logout
+                self.store.delete(session.sid)
+                response.delete_cookie(app.session_cookie_name, domain=domain, path=path)
+            return
+        if session.modified:
+            self.store.set(session.sid, session, time.time() + app.permanent_session_lifetime.total_seconds())
+            self._expire()
+        if session.new or session.modified or self.should_set_cookie(app, session):
+            response.set_cookie(app.session_cookie_name, session.sid,
+                                expires=self.get_expiration_time(app, session), httponly=self.get_cookie_httponly(app),
+                                domain=domain, path=path, secure=self.get_cookie_secure(app),
+                                samesite=self.get_cookie_samesite(app))
+
+    def _expire(self):
+        if time.time() >= self._next_expiry:
+            self._next_expiry = time.time() + self.expire_interval
+            self.store.expire()